@@ -13,10 +13,16 @@ def register():
         product.Template,
         product.Product,
         stock.Location,
+        stock.Move,
+        stock.QuantityPending,
+        stock.QuantitySnapshot,
+        stock.QuantitySnapshotDirty,
+        stock.Cron,
         stock.ProductsByLocations,
         module='product_quantity', type_='model')
     Pool.register(
         stock.Lot,
         stock.LotsByLocations,
+        stock.QuantityPendingLot,
         depends=['stock_lot'],
         module='product_quantity', type_='model')
@@ -1,8 +1,10 @@
 # This file is part product_quantity module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from trytond.cache import Cache
 from trytond.model import ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
 from trytond.modules.company.model import CompanyValueMixin
 
 
@@ -13,6 +15,9 @@ warehouse_quantity = fields.Selection([
 lag_days = fields.Numeric('Number of lag days', digits=(16, 0), help="Number of days "
     "to be added to the current day to compute Forecast, Incoming and Outgoing Quantity "
     "fields in product. Leave empty to take into account all future moves.")
+available_quantity_cache = fields.Integer('Available Quantity Cache',
+    help="Number of seconds the available quantity of products is kept in "
+    "cache. Leave empty to always compute it.")
 
 
 def default_func(field_name):
@@ -28,23 +33,50 @@ class Configuration(metaclass=PoolMeta):
     __name__ = 'stock.configuration'
     warehouse_quantity = fields.MultiValue(warehouse_quantity)
     lag_days = fields.MultiValue(lag_days)
+    available_quantity_cache = fields.MultiValue(available_quantity_cache)
+    _product_quantity_cache = Cache(
+        'stock.configuration.product_quantity', context=False)
 
     @classmethod
     def multivalue_model(cls, field):
         pool = Pool()
-        if field in ('warehouse_quantity', 'lag_days'):
+        if field in ('warehouse_quantity', 'lag_days',
+                'available_quantity_cache'):
             return pool.get('stock.configuration.product_quantity')
         return super(Configuration, cls).multivalue_model(field)
 
     default_warehouse_quantity = default_func('warehouse_quantity')
 
+    @classmethod
+    def get_product_quantity_values(cls):
+        "Return the product quantity settings of the context company"
+        company = Transaction().context.get('company')
+        values = cls._product_quantity_cache.get(company)
+        if values is None:
+            config = cls(1)
+            values = {
+                'warehouse_quantity': config.warehouse_quantity,
+                'lag_days': config.lag_days,
+                'available_quantity_cache': config.available_quantity_cache,
+                }
+            cls._product_quantity_cache.set(company, values)
+        return values
+
 
 class ConfigurationProductQuantity(ModelSQL, CompanyValueMixin):
     "Stock Configuration - Product Quantity"
     __name__ = 'stock.configuration.product_quantity'
     warehouse_quantity = warehouse_quantity
     lag_days = lag_days
+    available_quantity_cache = available_quantity_cache
 
     @classmethod
     def default_warehouse_quantity(cls):
         return 'all'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        super().on_modification(mode, records, field_names=field_names)
+        Configuration._product_quantity_cache.clear()
@@ -0,0 +1,155 @@
+# This file is part product_quantity module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Optional instrumentation of the quantity getters and searchers.
+
+It is enabled with the 'product_quantity_profile' context key or with:
+
+    [product_quantity]
+    profile = True
+
+Each profiled call is logged with the number of records, SQL statements,
+fetched rows and the wall time spent in each section. The totals per method
+are available with summary().
+
+The statistics are local to the thread so the statements of the partitions
+computed concurrently by parallel.run are not counted, only their wall time
+is included in the section of the profiled call.
+"""
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from trytond import config
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_summary_lock = threading.Lock()
+_summary = defaultdict(lambda: defaultdict(int))
+
+
+def enabled():
+    context = Transaction().context
+    if context.get('product_quantity_profile') is not None:
+        return bool(context['product_quantity_profile'])
+    return config.getboolean('product_quantity', 'profile', default=False)
+
+
+def summary():
+    "Return the totals of the profiled calls by method"
+    with _summary_lock:
+        return {k: dict(v) for k, v in _summary.items()}
+
+
+def _counting_cursor(base, stats):
+    class Cursor(base):
+        def execute(self, *args, **kwargs):
+            stats['queries'] += 1
+            return super().execute(*args, **kwargs)
+
+        def fetchone(self):
+            row = super().fetchone()
+            if row is not None:
+                stats['rows'] += 1
+            return row
+
+        def fetchmany(self, *args, **kwargs):
+            rows = super().fetchmany(*args, **kwargs)
+            stats['rows'] += len(rows)
+            return rows
+
+        def fetchall(self):
+            rows = super().fetchall()
+            stats['rows'] += len(rows)
+            return rows
+
+        def __next__(self):
+            row = super().__next__()
+            stats['rows'] += 1
+            return row
+    return Cursor
+
+
+@contextmanager
+def _count_statements(stats):
+    connection = Transaction().connection
+    if hasattr(connection, 'cursor_factory'):
+        # PostgreSQL
+        factory = connection.cursor_factory
+        connection.cursor_factory = _counting_cursor(factory, stats)
+        try:
+            yield
+        finally:
+            connection.cursor_factory = factory
+    elif hasattr(connection, '__dict__'):
+        # SQLite
+        factory = type(connection.cursor())
+        Cursor = _counting_cursor(factory, stats)
+        connection.cursor = lambda: super(
+            type(connection), connection).cursor(Cursor)
+        try:
+            yield
+        finally:
+            del connection.cursor
+    else:
+        yield
+
+
+def profile(method):
+    "Decorate the getter or searcher to profile each call"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            if getattr(_local, 'stats', None) is not None or not enabled():
+                return func(cls, *args, **kwargs)
+            stats = _local.stats = defaultdict(int)
+            if args and isinstance(args[0], (list, tuple)):
+                stats['records'] = len(args[0])
+            start = time.perf_counter()
+            try:
+                with _count_statements(stats):
+                    return func(cls, *args, **kwargs)
+            finally:
+                stats['time'] = time.perf_counter() - start
+                _local.stats = None
+                key = '%s.%s' % (cls.__name__, method)
+                logger.info('%s: %s', key, json.dumps(stats, sort_keys=True))
+                with _summary_lock:
+                    total = _summary[key]
+                    total['calls'] += 1
+                    for name, value in stats.items():
+                        total[name] += value
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def section(name):
+    "Add the wall time of the block to the current profiled call"
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats['time:%s' % name] += time.perf_counter() - start
+
+
+def timed(name):
+    "Decorate the function to add its wall time to the current profiled call"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with section(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,53 @@
+# This file is part product_quantity module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Optional concurrent computation of the quantities by partition of the
+warehouses.
+
+It is used on PostgreSQL in read-only transactions with:
+
+    [product_quantity]
+    parallel_warehouses = 4
+
+which is the maximum number of concurrent read-only connections used by a
+computation. The partitions are computed in new transactions so they do not
+see the changes of the current transaction, this is why it is not used in
+read-write transactions.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from trytond import backend, config
+from trytond.transaction import Transaction
+
+
+def workers():
+    "Return the number of concurrent partitions to use or 0"
+    if backend.name != 'postgresql' or not Transaction().readonly:
+        return 0
+    return config.getint(
+        'product_quantity', 'parallel_warehouses', default=0)
+
+
+def partition(ids, size):
+    "Split the ids into at most size partitions"
+    return [p for p in (ids[i::size] for i in range(size)) if p]
+
+
+def run(func, partitions):
+    """
+    Call func with each partition in its own read-only transaction and
+    return the results in the order of the partitions.
+    """
+    transaction = Transaction()
+    database_name = transaction.database.name
+    user = transaction.user
+    context = dict(transaction.context)
+
+    def call(partition):
+        with Transaction().start(
+                database_name, user, readonly=True, context=context):
+            return func(partition)
+
+    with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+        return list(executor.map(call, partitions))
@@ -1,28 +1,200 @@
 # This file is part product_quantity module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
 import operator
+import time
+from weakref import WeakKeyDictionary
+from collections import defaultdict
 from dateutil.relativedelta import relativedelta
+from trytond import backend
+from trytond.cache import Cache
 from trytond.pool import Pool, PoolMeta
 from trytond.model import fields
+from trytond.tools import grouped_slice, sqlite_apply_types
 from trytond.transaction import Transaction
+from sql import Column, Literal, Null
 from sql.aggregate import Sum
-from sql.conditionals import Coalesce
+from sql.conditionals import Case, Coalesce
+from sql.operators import Any
+
+from . import instrument, parallel
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Locations resolved to compute quantities, memoized per transaction
+_locations_cache = WeakKeyDictionary()
+
+
+def get_locations_cache():
+    "Return the memo of resolved locations of the current transaction"
+    return _locations_cache.setdefault(Transaction(), {})
+
+
+def clear_locations_cache():
+    _locations_cache.pop(Transaction(), None)
+
+
+def in_ids(column, ids):
+    """
+    Return the SQL expression testing if the column is one of the ids.
+    On PostgreSQL, the ids are sent as a single array parameter so the size
+    of the query does not depend on the number of ids.
+    """
+    if backend.name == 'postgresql':
+        return column == Any(list(ids))
+    return column.in_(list(ids))
+
+
+def split_ids(ids):
+    """
+    Return the lists of ids to use with in_ids in separated queries.
+    Only the backends without array parameters need to split them.
+    """
+    ids = list(ids)
+    if backend.name == 'postgresql' or not ids:
+        return [ids]
+    return [list(sub_ids) for sub_ids in grouped_slice(ids)]
+
+
+# Comparison operators supported by the quantity searchers
+QUANTITY_OPERATORS = {
+    '=': (operator.eq, operator.eq),
+    '!=': (operator.ne, operator.ne),
+    '<': (operator.lt, operator.lt),
+    '<=': (operator.le, operator.le),
+    '>': (operator.gt, operator.gt),
+    '>=': (operator.ge, operator.ge),
+    'in': (lambda v, o: v in o, lambda c, o: c.in_(list(o))),
+    'not in': (lambda v, o: v not in o, lambda c, o: ~c.in_(list(o))),
+    }
+
+
+def valid_quantity_clause(operator_, operand):
+    "Return True if the searchers can evaluate the clause"
+    if operand is None or operator_ not in QUANTITY_OPERATORS:
+        return False
+    if operator_ in {'in', 'not in'}:
+        return None not in operand
+    return True
+
+
+def match_quantities(quantities, operator_, operand):
+    """
+    Return the sequence of booleans telling for each quantity if it matches
+    the operator and operand.
+    The comparison is evaluated in bulk on an array when numpy is installed.
+    """
+    if numpy is None:
+        compare, _ = QUANTITY_OPERATORS[operator_]
+        return [compare(q, operand) for q in quantities]
+    values = numpy.fromiter(quantities, dtype=float)
+    if operator_ in {'in', 'not in'}:
+        mask = numpy.isin(values, numpy.array(list(operand), dtype=float))
+        return ~mask if operator_ == 'not in' else mask
+    compare, _ = QUANTITY_OPERATORS[operator_]
+    return compare(values, float(operand))
+
+
+def search_quantities(quantities, operator_, operand):
+    """
+    Return the domain matching the ids of the quantities dictionary whose
+    quantity matches the operator and operand.
+    """
+    if not valid_quantity_clause(operator_, operand):
+        return [('id', 'in', [])]
+    ids = list(quantities)
+    mask = match_quantities(
+        (quantities[i] or 0 for i in ids), operator_, operand)
+    return [('id', 'in', [i for i, matched in zip(ids, mask) if matched])]
+
+
+def search_quantity_query(query, name, operator_, operand):
+    """
+    Return the domain matching the records of the query (in the record
+    column) whose quantity in the name column matches the operator and
+    operand. The records missing from the query have a quantity of 0.
+    """
+    if not valid_quantity_clause(operator_, operand):
+        return [('id', 'in', [])]
+    with_zero = match_quantities([0], operator_, operand)[0]
+
+    if query is None:
+        return [] if with_zero else [('id', 'in', [])]
+
+    _, Operator = QUANTITY_OPERATORS[operator_]
+    domain = [('id', 'in', query.select(query.record,
+                where=Operator(Column(query, name), operand)))]
+    if with_zero:
+        domain = ['OR',
+            domain[0],
+            ('id', 'not in', query.select(query.record)),
+            ]
+    return domain
+
+
+def get_lazy_fields():
+    """
+    Return the names of the quantity fields that are not computed.
+
+    They are only set by the client with the 'quantity_lazy_fields' context
+    key of the request so the server side readers always get the values.
+    """
+    return set(Transaction().context.get('quantity_lazy_fields') or [])
+
+
+def get_snapshot_warehouses(location_ids):
+    """
+    Return the ids of the warehouses if the quantities of the locations can
+    be read from the snapshot or None.
+    """
+    pool = Pool()
+    Location = pool.get('stock.location')
+
+    context = Transaction().context
+    if not context.get('quantity_snapshot') or not location_ids:
+        return
+    if not context.get('with_childs', True):
+        return
+    if any(l.type != 'warehouse' for l in Location.browse(location_ids)):
+        return
+    return list(location_ids)
 
 
 class QuantityMixin:
     __slots__ = ()
+    # Set on the models whose quantities are stored in the snapshot
+    _quantity_snapshot = False
+    # Set on the models whose quantities are the sum by locations
+    _quantity_parallel = True
     available_quantity = fields.Function(fields.Float('Available Quantity'),
         'get_quantity', searcher='search_quantity')
 
+    @classmethod
+    def _quantity_snapshot_warehouses(cls, name):
+        """
+        Return the ids of the warehouses from which the quantity is read in
+        the snapshot or None if it must be computed.
+        """
+        if (not cls._quantity_snapshot
+                or name not in {'available_quantity', 'incoming_quantity',
+                    'outgoing_quantity'}):
+            return
+        location_ids = (Transaction().context.get('locations')
+            or cls._quantity_locations(name))
+        return get_snapshot_warehouses(location_ids)
+
     @classmethod
     def _quantity_context(cls, name):
         pool = Pool()
         Date = pool.get('ir.date')
         Configuration = pool.get('stock.configuration')
 
-        config = Configuration(1)
-        lag_days = config.lag_days or 0
+        config = Configuration.get_product_quantity_values()
+        lag_days = config['lag_days'] or 0
         today = Date.today() + relativedelta(days=int(lag_days))
 
         new_context = {}
@@ -35,6 +207,7 @@ class QuantityMixin:
         return new_context
 
     @classmethod
+    @instrument.timed('_quantity_locations')
     def _quantity_locations(cls, name=None):
         pool = Pool()
         Configuration = pool.get('stock.configuration')
@@ -44,39 +217,131 @@ class QuantityMixin:
 
         location_ids = context.get('locations', [])
         if not context.get('locations'):
-            config = Configuration(1)
+            config = Configuration.get_product_quantity_values()
+            warehouse_quantity = config['warehouse_quantity']
             warehouse_id = context.get('warehouse')
 
+            cache = get_locations_cache()
+            key = ('quantity', context.get('company'), warehouse_id,
+                warehouse_quantity)
+            if key in cache:
+                return list(cache[key])
+
             warehouses = []
-            if warehouse_id and config.warehouse_quantity == 'user':
+            if warehouse_id and warehouse_quantity == 'user':
                 warehouses = [Location(warehouse_id)]
-            elif (config.warehouse_quantity == 'all'
-                    or config.warehouse_quantity is None):
+            elif (warehouse_quantity == 'all'
+                    or warehouse_quantity is None):
                 warehouses = Location.search([('type', '=', 'warehouse')])
 
             if warehouses:
                 location_ids = [w.id for w in warehouses]
+            cache[key] = tuple(location_ids)
         return location_ids
 
     @classmethod
+    @instrument.profile('get_quantity')
     def get_quantity(cls, products, name):
+        pool = Pool()
+        Snapshot = pool.get('product.quantity.snapshot')
         context = Transaction().context
 
+        if name in get_lazy_fields():
+            return dict.fromkeys(map(int, products))
+
+        warehouse_ids = cls._quantity_snapshot_warehouses(name)
+        if warehouse_ids is not None:
+            with instrument.section('snapshot'):
+                return Snapshot.get_quantities(
+                    products, warehouse_ids, [name])[name]
+
         if not context.get('locations'):
-            with Transaction().set_context(locations=cls._quantity_locations(name),
-                    with_childs=context.get('with_childs', True)):
+            location_ids = cls._quantity_locations(name)
+            workers = parallel.workers() if cls._quantity_parallel else 0
+            if workers > 1 and len(location_ids) > 1:
+                with instrument.section('get_quantity'):
+                    return cls._get_quantity_parallel(
+                        products, name, location_ids, workers)
+            with Transaction().set_context(locations=location_ids,
+                    with_childs=context.get('with_childs', True)), \
+                    instrument.section('get_quantity'):
                 return super().get_quantity(products, name)
-        return super().get_quantity(products, name)
+        with instrument.section('get_quantity'):
+            return super().get_quantity(products, name)
 
     @classmethod
+    def _get_quantity_parallel(cls, records, name, location_ids, workers):
+        """
+        Compute the quantity of the records for partitions of the locations
+        in concurrent transactions and return the sum of the results.
+        """
+        record_ids = list(map(int, records))
+        with_childs = Transaction().context.get('with_childs', True)
+
+        def compute(location_ids):
+            Model = Pool().get(cls.__name__)
+            with Transaction().set_context(
+                    locations=location_ids, with_childs=with_childs):
+                return Model.get_quantity(Model.browse(record_ids), name)
+
+        quantities = dict.fromkeys(record_ids, 0)
+        for result in parallel.run(
+                compute, parallel.partition(location_ids, workers)):
+            for record_id, quantity in result.items():
+                quantities[record_id] += quantity or 0
+        return quantities
+
+    @classmethod
+    @instrument.profile('search_quantity')
     def search_quantity(cls, name, domain=None):
+        pool = Pool()
+        Snapshot = pool.get('product.quantity.snapshot')
         context = Transaction().context
 
+        warehouse_ids = cls._quantity_snapshot_warehouses(name)
+        if warehouse_ids is not None:
+            _, operator_, operand = domain
+            return search_quantity_query(
+                Snapshot.get_quantity_query(warehouse_ids), name,
+                operator_, operand)
+
         if not context.get('locations'):
             with Transaction().set_context(locations=cls._quantity_locations(name),
-                    with_childs=context.get('with_childs', True)):
+                    with_childs=context.get('with_childs', True)), \
+                    instrument.section('search_quantity'):
                 return super().search_quantity(name, domain)
-        return super().search_quantity(name, domain)
+        with instrument.section('search_quantity'):
+            return super().search_quantity(name, domain)
+
+    @classmethod
+    def _search_quantity(cls, name, location_ids, domain=None,
+            grouping=('product',), position=-1):
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        context = Transaction().context
+        if not location_ids or not domain:
+            return []
+        _, operator_, operand = domain
+        if (len(location_ids) == 1
+                and not context.get('stock_skip_warehouse')
+                and operator_ in fields.SQL_OPERATORS):
+            return super()._search_quantity(name, location_ids, domain,
+                grouping=grouping, position=position)
+        if not valid_quantity_clause(operator_, operand):
+            return [('id', 'in', [])]
+
+        with_childs = context.get('with_childs', len(location_ids) == 1)
+        with Transaction().set_context(cls._quantity_context(name)):
+            pbl = Product.products_by_location(
+                location_ids, with_childs=with_childs, grouping=grouping)
+
+        quantities = defaultdict(float)
+        for key, quantity in pbl.items():
+            # pbl could return None in some keys
+            if key[position] is not None:
+                quantities[key[position]] += quantity
+        return search_quantities(quantities, operator_, operand)
 
 
 class QuantityByMixin:
@@ -86,114 +351,785 @@ class QuantityByMixin:
     outgoing_quantity = fields.Function(fields.Float('Outgoing Quantity'),
         'get_in_out_quantity', searcher='search_in_out_quantity')
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        # Read the quantity fields with a single getter call
+        for name in ['quantity', 'forecast_quantity', 'available_quantity',
+                'incoming_quantity', 'outgoing_quantity']:
+            field = getattr(cls, name, None)
+            if field and field.getter in {
+                    'get_quantity', 'get_in_out_quantity'}:
+                field.getter = 'get_quantities'
+
+    @classmethod
+    @instrument.profile('get_quantities')
+    def get_quantities(cls, records, names):
+        """
+        Compute the quantity fields together, resolving the locations once
+        and reading the snapshot fields with a single query.
+        """
+        pool = Pool()
+        Snapshot = pool.get('product.quantity.snapshot')
+
+        context = Transaction().context
+        location_ids = (context.get('locations')
+            or cls._quantity_locations())
+        lazy_fields = get_lazy_fields()
+        res = {}
+        # Only the snapshot and the in/out quantities use the resolved
+        # locations, get_quantity resolves them itself to keep its parallel
+        # path when no location is in the context
+        with Transaction().set_context(locations=location_ids,
+                with_childs=context.get('with_childs', True)):
+            snapshot_names = [n for n in names
+                if n not in lazy_fields
+                and cls._quantity_snapshot_warehouses(n) is not None]
+            if snapshot_names:
+                with instrument.section('snapshot'):
+                    res.update(Snapshot.get_quantities(records,
+                            get_snapshot_warehouses(location_ids),
+                            snapshot_names))
+            in_out_names = [n for n in names
+                if n not in res
+                and n in {'incoming_quantity', 'outgoing_quantity'}]
+            if in_out_names:
+                res.update(cls.get_in_out_quantities(records, in_out_names))
+        for name in names:
+            if name not in res:
+                res[name] = cls.get_quantity(records, name)
+        return res
+
     @classmethod
     def get_in_out_quantity(cls, products, name):
+        return cls.get_in_out_quantities(products, [name])[name]
+
+    @classmethod
+    @instrument.profile('get_in_out_quantities')
+    def get_in_out_quantities(cls, products, names):
+        """
+        Compute the incoming and outgoing quantity fields together with a
+        single query.
+        """
+        pool = Pool()
+        Snapshot = pool.get('product.quantity.snapshot')
+
         product_ids = list(map(int, products))
-        res = dict((x, 0) for x in product_ids)
-        if not products:
+        res = dict((n, dict((x, 0) for x in product_ids)) for n in names)
+        lazy_fields = get_lazy_fields()
+        for name in lazy_fields.intersection(names):
+            res[name] = dict.fromkeys(product_ids)
+        names = [n for n in names if n not in lazy_fields]
+        if not products or not names:
             return res
 
-        direction = 'in' if name == 'incoming_quantity' else 'out'
-        pbl = cls._get_in_out_quantity(product_ids, direction)
-        for product_id in product_ids:
-            res[product_id] = pbl.get(product_id, 0)
+        warehouse_ids = cls._quantity_snapshot_warehouses(names[0])
+        if warehouse_ids is not None:
+            with instrument.section('snapshot'):
+                res.update(
+                    Snapshot.get_quantities(products, warehouse_ids, names))
+            return res
+
+        pbl = cls._get_in_out_quantities(product_ids)
+        for name in names:
+            direction = 'in' if name == 'incoming_quantity' else 'out'
+            for product_id in product_ids:
+                res[name][product_id] = pbl[direction].get(product_id, 0)
         return res
 
+    @classmethod
+    def _in_out_grouping(cls):
+        "Return the stock.move column by which in/out quantities are grouped"
+        return 'product'
+
     @classmethod
     def _get_in_out_quantity(cls, product_ids=[], direction='in'):
+        return cls._get_in_out_quantities(product_ids)[direction]
+
+    @classmethod
+    @instrument.timed('_get_in_out_locations')
+    def _get_in_out_locations(cls):
+        """
+        Return the storage, supplier and customer location ids used to
+        compute incoming and outgoing quantities.
+        """
         pool = Pool()
         Location = pool.get('stock.location')
-        Move = pool.get('stock.move')
-
-        move = Move.__table__()
-
-        transaction = Transaction()
-        context = transaction.context
-        cursor = transaction.connection.cursor()
 
-        location_ids = context.get('locations')
+        location_ids = Transaction().context.get('locations')
         if not location_ids:
             location_ids = cls._quantity_locations()
         if not location_ids:
-            return {}
+            return [], [], []
+
+        cache = get_locations_cache()
+        key = ('in_out', tuple(sorted(location_ids)))
+        if key in cache:
+            return tuple(list(ids) for ids in cache[key])
+
+        location = Location.__table__()
+        parent = Location.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # The storage locations are children of the locations so their
+        # bounds are inside the bounds of one of them
+        query = location.join(parent, type_='LEFT',
+            condition=(location.type == 'storage')
+            & (parent.left <= location.left)
+            & (location.right <= parent.right)
+            & in_ids(parent.id, location_ids)
+            ).select(location.id, location.type,
+                where=(location.active == Literal(True))
+                & (((location.type == 'storage') & (parent.id != Null))
+                    | location.type.in_(['supplier', 'customer'])))
+        cursor.execute(*query)
+        ids = {'storage': set(), 'supplier': set(), 'customer': set()}
+        for location_id, type_ in cursor:
+            ids[type_].add(location_id)
+        location_ids = sorted(ids['storage'])
+        if not location_ids:
+            location_supplier_ids = location_customer_ids = []
+        else:
+            location_supplier_ids = sorted(ids['supplier'])
+            location_customer_ids = sorted(ids['customer'])
+        cache[key] = (tuple(location_ids), tuple(location_supplier_ids),
+            tuple(location_customer_ids))
+        return location_ids, location_supplier_ids, location_customer_ids
 
-        locations = Location.search([
-                ('parent', 'child_of', location_ids),
-                ('type', '=', 'storage'),
-                ])
-        location_ids = list(set(x.id for x in locations))
+    @classmethod
+    def _get_in_out_quantity_query(cls, product_ids=None,
+            with_location=False):
+        """
+        Return the query that computes incoming and outgoing quantities
+        grouped by record or None if there is nothing to compute.
+
+        product_ids are the ids of the records to compute.
+        The query has the columns record, incoming_quantity and
+        outgoing_quantity. If with_location is set, the quantities are also
+        grouped by the storage location in the location column.
+        """
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        Date = pool.get('ir.date')
+        Move = pool.get('stock.move')
+        Pending = pool.get('product.quantity.pending')
+
+        move = Move.__table__()
+        context = Transaction().context
+
+        location_ids, location_supplier_ids, location_customer_ids = (
+            cls._get_in_out_locations())
         if not location_ids:
-            return {}
+            return
+        if not location_supplier_ids and not location_customer_ids:
+            return
+
+        date_end = None
+        lag_days = Configuration.get_product_quantity_values()['lag_days']
+        if lag_days is not None:
+            date_end = Date.today() + relativedelta(days=int(lag_days))
+
+        if Pending.enabled():
+            return Pending.get_quantity_query(
+                location_ids, grouping=cls._in_out_grouping(),
+                record_ids=product_ids, date_end=date_end,
+                with_location=with_location)
+
+        in_where = Literal(False)
+        if location_supplier_ids:
+            in_where = (in_ids(move.from_location, location_supplier_ids)
+                & in_ids(move.to_location, location_ids))
+        out_where = Literal(False)
+        if location_customer_ids:
+            out_where = (in_ids(move.from_location, location_ids)
+                & in_ids(move.to_location, location_customer_ids))
 
         sql_where = move.company == context.get('company', -1)
         sql_where &= move.state == 'draft'
+        sql_where &= (in_where | out_where)
+        if date_end:
+            sql_where &= (Coalesce(
+                    move.effective_date, move.planned_date,
+                    datetime.date.max) <= date_end)
+        record = Column(move, cls._in_out_grouping())
         if product_ids:
-            sql_where &= move.product.in_(product_ids)
-        if direction == 'in':
-            location_supplier_ids = [l.id for l in Location.search([
-                ('type', '=', 'supplier'),
-                ])]
-            if not location_supplier_ids:
-                return {}
-            sql_where &= move.from_location.in_(location_supplier_ids)
-            sql_where &= move.to_location.in_(location_ids)
+            sql_where &= in_ids(record, product_ids)
         else:
-            location_customer_ids = [l.id for l in Location.search([
-                ('type', '=', 'customer'),
-                ])]
-            if not location_customer_ids:
-                return {}
-            sql_where &= move.from_location.in_(location_ids)
-            sql_where &= move.to_location.in_(location_customer_ids)
-
-        query = move.select(
-            move.product,
-            Coalesce(Sum(move.internal_quantity), 0).as_('quantity'),
+            sql_where &= record != Null
+
+        columns = [record.as_('record')]
+        group_by = [record]
+        if with_location:
+            location = Case(
+                (in_where, move.to_location), else_=move.from_location)
+            columns.append(location.as_('location'))
+            group_by.append(location)
+        return move.select(
+            *columns,
+            Sum(Case((in_where, move.internal_quantity), else_=0)
+                ).as_('incoming_quantity'),
+            Sum(Case((out_where, move.internal_quantity), else_=0)
+                ).as_('outgoing_quantity'),
             where=sql_where,
-            group_by=move.product)
-        cursor.execute(*query)
+            group_by=group_by)
 
-        return {product_id: quantity for product_id, quantity in cursor.fetchall()}
+    @classmethod
+    def _get_location_warehouses(cls, warehouse_ids):
+        """
+        Return a dictionary with the storage locations of the warehouses as
+        key and their warehouse as value.
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+
+        warehouse_ids = set(warehouse_ids)
+        location2warehouse = {}
+        for location_id, (type_, _, ancestors) in (
+                Location.get_location_tree().items()):
+            if type_ != 'storage':
+                continue
+            # The innermost warehouse is the nearest ancestor
+            for ancestor_id in ancestors:
+                if ancestor_id in warehouse_ids:
+                    location2warehouse[location_id] = ancestor_id
+                    break
+        return location2warehouse
 
     @classmethod
-    def search_in_out_quantity(cls, name, domain=None):
-        _, operator_, operand = domain
+    def _quantity_grouping(cls):
+        "Return the grouping of products_by_location for the records"
+        return ('product',)
+
+    @classmethod
+    def _quantity_grouping_filter(cls, records):
+        "Return the grouping filter of products_by_location for the records"
+        return (list(map(int, records)),)
+
+    @classmethod
+    def get_warehouse_quantities(cls, records, warehouses=None):
+        """
+        Compute the available, incoming and outgoing quantities of the
+        records in each warehouse.
+        If warehouses is None, all the warehouses are used.
+
+        Return a dictionary with the record id as key and a dictionary of
+        warehouse id and (available, incoming, outgoing) as value.
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+
+        cursor = Transaction().connection.cursor()
+
+        if warehouses is None:
+            warehouses = Location.search([('type', '=', 'warehouse')])
+        warehouse_ids = list(map(int, warehouses))
+        quantities = dict((r.id, dict((w, [0, 0, 0]) for w in warehouse_ids))
+            for r in records)
+        if not records or not warehouse_ids:
+            return dict((r, {}) for r in quantities)
+        location2warehouse = cls._get_location_warehouses(warehouse_ids)
+
+        grouping = cls._quantity_grouping()
+        for sub_records in grouped_slice(records):
+            sub_records = list(sub_records)
+            with Transaction().set_context(
+                    cls._quantity_context('available_quantity')):
+                pbl = Product.products_by_location(
+                    warehouse_ids, with_childs=True, grouping=grouping,
+                    grouping_filter=cls._quantity_grouping_filter(
+                        sub_records))
+            for key, quantity in pbl.items():
+                location_id, record_id = key[0], key[-1]
+                if (record_id in quantities
+                        and location_id in quantities[record_id]):
+                    quantities[record_id][location_id][0] += quantity
+
+            with Transaction().set_context(locations=warehouse_ids):
+                query = cls._get_in_out_quantity_query(
+                    [r.id for r in sub_records], with_location=True)
+            if query is None:
+                continue
+            cursor.execute(*query)
+            for record_id, location_id, incoming, outgoing in (
+                    cursor.fetchall()):
+                warehouse_id = location2warehouse.get(location_id)
+                if record_id in quantities and warehouse_id:
+                    values = quantities[record_id][warehouse_id]
+                    values[1] += incoming or 0
+                    values[2] += outgoing or 0
+        return dict(
+            (r, dict((w, tuple(v)) for w, v in q.items()))
+            for r, q in quantities.items())
+
+    @classmethod
+    @instrument.timed('_get_in_out_quantity')
+    def _get_in_out_quantities(cls, product_ids=[]):
+        """
+        Compute incoming and outgoing quantities with a single query (by
+        slice of ids on the backends without array parameters).
 
-        direction = 'in' if name == 'incoming_quantity' else 'out'
-        pbl = cls._get_in_out_quantity(product_ids=[], direction=direction)
+        Return a dictionary with the direction ('in' or 'out') as key and
+        a dictionary of product id and quantity as value.
+        """
+        cursor = Transaction().connection.cursor()
 
-        operator_ = {
-            '=': operator.eq,
-            '>=': operator.ge,
-            '>': operator.gt,
-            '<=': operator.le,
-            '<': operator.lt,
-            '!=': operator.ne,
-            'in': lambda v, l: v in l,
-            'not in': lambda v, l: v not in l,
-            }.get(operator_, lambda v, l: False)
-        record_ids = []
-        for product, quantity in pbl.items():
-            if (quantity is not None and operand is not None
-                    and operator_(quantity, operand)):
-                record_ids.append(product)
+        res = {'in': {}, 'out': {}}
+        for sub_ids in split_ids(product_ids):
+            query = cls._get_in_out_quantity_query(sub_ids)
+            if query is None:
+                return res
+            cursor.execute(*query)
 
-        return [('id', 'in', record_ids)]
+            for product_id, incoming, outgoing in cursor.fetchall():
+                res['in'][product_id] = incoming or 0
+                res['out'][product_id] = outgoing or 0
+        return res
+
+    @classmethod
+    @instrument.profile('search_in_out_quantity')
+    def search_in_out_quantity(cls, name, domain=None):
+        pool = Pool()
+        Snapshot = pool.get('product.quantity.snapshot')
+
+        _, operator_, operand = domain
+        warehouse_ids = cls._quantity_snapshot_warehouses(name)
+        if warehouse_ids is not None:
+            query = Snapshot.get_quantity_query(warehouse_ids)
+        else:
+            query = cls._get_in_out_quantity_query()
+        return search_quantity_query(query, name, operator_, operand)
 
 
 class Template(metaclass=PoolMeta):
     __name__ = 'product.template'
     available_quantity = fields.Function(fields.Float('Available Quantity'),
-        'get_product_quantity')
+        'get_product_quantity', searcher='search_product_quantity')
     incoming_quantity = fields.Function(fields.Float('Incoming Quantity'),
-        'get_product_quantity')
+        'get_product_quantity', searcher='search_product_quantity')
     outgoing_quantity = fields.Function(fields.Float('Outgoing Quantity'),
-        'get_product_quantity')
+        'get_product_quantity', searcher='search_product_quantity')
+
+    @classmethod
+    def _quantity_snapshot_warehouses(cls):
+        """
+        Return the ids of the warehouses from which the quantities are read
+        in the snapshot or None if they must be computed.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        location_ids = (Transaction().context.get('locations')
+            or Product._quantity_locations())
+        return get_snapshot_warehouses(location_ids)
+
+    @classmethod
+    def get_product_quantity(cls, templates, names):
+        pool = Pool()
+        Product = pool.get('product.product')
+        Snapshot = pool.get('product.quantity.snapshot')
 
-    def get_product_quantity(self, name):
-        return sum([getattr(p, name) or 0 for p in self.products
-            if hasattr(p, name)])
+        res = dict((n, dict((t.id, 0.) for t in templates)) for n in names)
+        lazy_fields = get_lazy_fields()
+        for name in lazy_fields.intersection(names):
+            res[name] = dict.fromkeys(t.id for t in templates)
+        names = [n for n in names if n not in lazy_fields]
+        if not names:
+            return res
+
+        warehouse_ids = cls._quantity_snapshot_warehouses()
+        if warehouse_ids is not None:
+            res.update(Snapshot.get_quantities(
+                    templates, warehouse_ids, names, grouping='template'))
+            return res
+
+        products = [p for t in templates for p in t.products]
+        if not products:
+            return res
+
+        quantities = {}
+        if 'available_quantity' in names:
+            quantities['available_quantity'] = Product.get_quantity(
+                products, 'available_quantity')
+        in_out_names = [n for n in names if n != 'available_quantity']
+        if in_out_names:
+            quantities.update(
+                Product.get_in_out_quantities(products, in_out_names))
+        for name in names:
+            for product in products:
+                res[name][product.template.id] += (
+                    quantities[name].get(product.id) or 0)
+        return res
+
+    @classmethod
+    def search_product_quantity(cls, name, domain=None):
+        pool = Pool()
+        Product = pool.get('product.product')
+        Snapshot = pool.get('product.quantity.snapshot')
+
+        _, operator_, operand = domain
+        warehouse_ids = cls._quantity_snapshot_warehouses()
+        if warehouse_ids is not None:
+            return search_quantity_query(
+                Snapshot.get_quantity_query(
+                    warehouse_ids, grouping='template'),
+                name, operator_, operand)
+
+        if name == 'available_quantity':
+            context = Transaction().context
+            location_ids = (context.get('locations')
+                or Product._quantity_locations(name))
+            with Transaction().set_context(
+                    with_childs=context.get('with_childs', True)):
+                return Product._search_quantity(name, location_ids, domain,
+                    grouping=('product.template',))
+
+        return search_quantity_query(
+            cls._get_quantity_query(name), name, operator_, operand)
+
+    @classmethod
+    def _get_quantity_query(cls, name):
+        """
+        Return the query computing from the moves the quantity of the
+        templates in the name column by template in the record column or
+        None.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+
+        if name == 'available_quantity':
+            context = Transaction().context
+            location_ids = (context.get('locations')
+                or Product._quantity_locations(name))
+            with Transaction().set_context(Product._quantity_context(name)):
+                query = Move.compute_quantities_query(location_ids,
+                    with_childs=context.get('with_childs', True),
+                    grouping=('product.template',))
+            if query is None:
+                return
+            # The moves between the locations cancel each other
+            record = Column(query, 'product.template')
+            return query.select(
+                record.as_('record'), Sum(query.quantity).as_(name),
+                group_by=[record])
+
+        query = Product._get_in_out_quantity_query()
+        if query is None:
+            return
+        product = Product.__table__()
+        return query.join(product,
+            condition=query.record == product.id
+            ).select(
+                product.template.as_('record'),
+                Sum(query.incoming_quantity).as_('incoming_quantity'),
+                Sum(query.outgoing_quantity).as_('outgoing_quantity'),
+                group_by=[product.template])
+
+    @classmethod
+    def _order_quantity(cls, tables, name):
+        """
+        Return the order by the quantity of the snapshot or, without the
+        quantity_snapshot context, by the quantity computed from the moves.
+        """
+        pool = Pool()
+        Snapshot = pool.get('product.quantity.snapshot')
+
+        template, _ = tables[None]
+        warehouse_ids = cls._quantity_snapshot_warehouses()
+        if warehouse_ids is not None:
+            key = 'quantity_snapshot'
+        else:
+            key = 'quantity_%s' % name
+        if key not in tables:
+            if warehouse_ids is not None:
+                query = Snapshot.get_quantity_query(
+                    warehouse_ids, grouping='template')
+            else:
+                query = cls._get_quantity_query(name)
+            if query is None:
+                return []
+            join = template.join(query, type_='LEFT',
+                condition=query.record == template.id)
+            tables[key] = {
+                None: (join.right, join.condition),
+                }
+        query, _ = tables[key][None]
+        return [Coalesce(Column(query, name), 0)]
+
+    @classmethod
+    def order_available_quantity(cls, tables):
+        return cls._order_quantity(tables, 'available_quantity')
+
+    @classmethod
+    def order_incoming_quantity(cls, tables):
+        return cls._order_quantity(tables, 'incoming_quantity')
+
+    @classmethod
+    def order_outgoing_quantity(cls, tables):
+        return cls._order_quantity(tables, 'outgoing_quantity')
+
+    @classmethod
+    def refresh_quantity_snapshot(cls, templates):
+        "Refresh the quantity snapshot of the variants of the templates"
+        pool = Pool()
+        Snapshot = pool.get('product.quantity.snapshot')
+        Snapshot.refresh([p for t in templates for p in t.products])
 
 
 class Product(QuantityMixin, QuantityByMixin, metaclass=PoolMeta):
     __name__ = 'product.product'
+    _quantity_snapshot = True
+    _available_quantity_cache = Cache(
+        'product.product.available_quantity', context=False)
+    # The generation of each product is part of the key of its quantities
+    _available_quantity_generation = Cache(
+        'product.product.available_quantity.generation', context=False)
+
+    @classmethod
+    def clear_available_quantity_cache(cls, products):
+        """
+        Expire the cached available quantity of the products.
+        The other processes using the memory cache keep their values until
+        the end of the time window.
+        """
+        for product_id in set(map(int, products)):
+            generation = cls._available_quantity_generation.get(product_id, 0)
+            cls._available_quantity_generation.set(
+                product_id, generation + 1)
+
+    @classmethod
+    def get_quantity(cls, products, name):
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+
+        duration = Configuration.get_product_quantity_values()[
+            'available_quantity_cache']
+        context = Transaction().context
+        if (name != 'available_quantity' or not duration
+                or context.get('quantity_snapshot')
+                or name in get_lazy_fields()):
+            return super().get_quantity(products, name)
+
+        location_ids = (context.get('locations')
+            or cls._quantity_locations(name))
+        # The time window is part of the key to expire the values
+        key = (context.get('company'), tuple(sorted(location_ids)),
+            context.get('with_childs', True),
+            bool(context.get('stock_skip_warehouse')),
+            cls._quantity_context(name)['stock_date_end'],
+            int(time.time() // duration))
+
+        def product_key(product_id):
+            return key + (product_id,
+                cls._available_quantity_generation.get(product_id, 0))
+
+        res, missing = {}, []
+        for product in products:
+            quantity = cls._available_quantity_cache.get(
+                product_key(product.id))
+            if quantity is None:
+                missing.append(product)
+            else:
+                res[product.id] = quantity
+        if missing:
+            quantities = super().get_quantity(missing, name)
+            for product_id, quantity in quantities.items():
+                cls._available_quantity_cache.set(
+                    product_key(product_id), quantity)
+            res.update(quantities)
+        return res
+
+    @classmethod
+    def _get_quantity_query(cls, name):
+        """
+        Return the query computing from the moves the quantity of the
+        products in the name column by product in the record column or None.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        if name in {'incoming_quantity', 'outgoing_quantity'}:
+            return cls._get_in_out_quantity_query()
+
+        context = Transaction().context
+        location_ids = (context.get('locations')
+            or cls._quantity_locations(name))
+        with Transaction().set_context(cls._quantity_context(name)):
+            query = Move.compute_quantities_query(location_ids,
+                with_childs=context.get('with_childs', True),
+                grouping=('product',))
+        if query is None:
+            return
+        # The moves between the locations cancel each other
+        return query.select(
+            query.product.as_('record'), Sum(query.quantity).as_(name),
+            group_by=[query.product])
+
+    @classmethod
+    def _order_quantity(cls, tables, name):
+        """
+        Return the order by the quantity of the snapshot or, without the
+        quantity_snapshot context, by the quantity computed from the moves.
+        """
+        pool = Pool()
+        Snapshot = pool.get('product.quantity.snapshot')
+
+        product, _ = tables[None]
+        warehouse_ids = cls._quantity_snapshot_warehouses(name)
+        if warehouse_ids is not None:
+            key = 'quantity_snapshot'
+        else:
+            key = 'quantity_%s' % name
+        if key not in tables:
+            if warehouse_ids is not None:
+                query = Snapshot.get_quantity_query(warehouse_ids)
+            else:
+                query = cls._get_quantity_query(name)
+            if query is None:
+                return []
+            join = product.join(query, type_='LEFT',
+                condition=query.record == product.id)
+            tables[key] = {
+                None: (join.right, join.condition),
+                }
+        query, _ = tables[key][None]
+        return [Coalesce(Column(query, name), 0)]
+
+    @classmethod
+    def order_available_quantity(cls, tables):
+        return cls._order_quantity(tables, 'available_quantity')
+
+    @classmethod
+    def order_incoming_quantity(cls, tables):
+        return cls._order_quantity(tables, 'incoming_quantity')
+
+    @classmethod
+    def order_outgoing_quantity(cls, tables):
+        return cls._order_quantity(tables, 'outgoing_quantity')
+
+    @classmethod
+    def get_availability_series(cls, products, date_end, date_start=None):
+        """
+        Return the available quantity of the products for each day from
+        date_start (today by default and not before) to date_end.
+
+        The quantity at date_start is computed like available_quantity and
+        the following days are accumulated from a single ordered query on
+        the moves between the dates.
+        Return a dictionary with the product id as key and the list of
+        (date, quantity) as value.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Move = pool.get('stock.move')
+
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+        context = Transaction().context
+
+        today = Date.today()
+        date_start = max(date_start or today, today)
+        dates = [date_start + datetime.timedelta(days=i)
+            for i in range((date_end - date_start).days + 1)]
+        product_ids = list(map(int, products))
+        if not dates or not product_ids:
+            return dict((p, []) for p in product_ids)
+
+        location_ids = (context.get('locations')
+            or cls._quantity_locations('available_quantity'))
+        base = dict.fromkeys(product_ids, 0)
+        with Transaction().set_context(
+                cls._quantity_context('available_quantity'),
+                stock_date_end=date_start):
+            pbl = cls.products_by_location(
+                location_ids, with_childs=True,
+                grouping_filter=(product_ids,))
+        for key, quantity in pbl.items():
+            if key[-1] in base:
+                base[key[-1]] += quantity
+        with Transaction().set_context(locations=location_ids):
+            storage_ids, _, _ = cls._get_in_out_locations()
+
+        deltas = dict((p, {}) for p in product_ids)
+        if storage_ids:
+            move_date = Move.effective_date.sql_cast(Coalesce(
+                    move.effective_date,
+                    Case((move.state == 'assigned', today), else_=Null),
+                    move.planned_date))
+            to_storage = in_ids(move.to_location, storage_ids)
+            from_storage = in_ids(move.from_location, storage_ids)
+            incoming = to_storage & ~from_storage
+            outgoing = from_storage & ~to_storage
+            # The moves of today not counted in the quantity of today are
+            # added to the next day like the future quantities do
+            counted = ((move.state == 'done')
+                | ((move.state == 'assigned') & outgoing))
+            where = move.company == context.get('company', -1)
+            where &= move.state.in_(['draft', 'assigned', 'done'])
+            where &= (incoming | outgoing)
+            where &= (move_date <= date_end)
+            if date_start == today:
+                where &= ((move_date > date_start)
+                    | ((move_date == today) & ~counted))
+            else:
+                where &= move_date > date_start
+            for sub_ids in split_ids(product_ids):
+                query = move.select(
+                    move.product.as_('product'), move_date.as_('date'),
+                    Sum(Case((incoming, move.internal_quantity), else_=0)
+                        - Case((outgoing, move.internal_quantity), else_=0)
+                        ).as_('quantity'),
+                    where=where & in_ids(move.product, sub_ids),
+                    group_by=[move.product, move_date],
+                    order_by=[move.product, move_date])
+                if backend.name == 'sqlite':
+                    sqlite_apply_types(query, [None, 'DATE', None])
+                cursor.execute(*query)
+                for product_id, date, quantity in cursor:
+                    date = max(date, date_start + datetime.timedelta(days=1))
+                    deltas[product_id][date] = (
+                        deltas[product_id].get(date, 0) + (quantity or 0))
+
+        series = {}
+        for product_id in product_ids:
+            quantity = base[product_id]
+            series[product_id] = values = []
+            for date in dates:
+                quantity += deltas[product_id].get(date, 0)
+                values.append((date, quantity))
+        return series
+
+    @classmethod
+    def export_quantities(cls, domain=None, chunk_size=1000):
+        """
+        Yield (id, code, available, incoming, outgoing) for the products
+        matching the domain, computing chunk_size products at a time.
+        """
+        context = Transaction().context
+        locations = (context.get('locations')
+            or cls._quantity_locations('available_quantity'))
+        quantity_context = {
+            'locations': locations,
+            'with_childs': context.get('with_childs', True),
+            'quantity_lazy_fields': [],
+            }
+        in_out_names = ['incoming_quantity', 'outgoing_quantity']
+
+        last_id = None
+        while True:
+            with Transaction().set_context(quantity_context):
+                chunk_domain = [domain or []]
+                if last_id is not None:
+                    chunk_domain.append(('id', '>', last_id))
+                products = cls.search(
+                    chunk_domain, order=[('id', 'ASC')], limit=chunk_size)
+                if not products:
+                    break
+                available = cls.get_quantity(products, 'available_quantity')
+                in_out = cls.get_in_out_quantities(products, in_out_names)
+            for product in products:
+                yield (product.id, product.code,
+                    available[product.id],
+                    in_out['incoming_quantity'][product.id],
+                    in_out['outgoing_quantity'][product.id])
+            last_id = products[-1].id
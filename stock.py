@@ -1,34 +1,705 @@
 # This file is part product_quantity module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.pool import PoolMeta
-from trytond.model import fields
-from trytond.modules.product_quantity.product import QuantityMixin, QuantityByMixin
+import datetime
+from sql import Column, Literal, Null
+from sql.aggregate import Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+from trytond import config
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.model import Index, ModelSQL, fields
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from trytond.modules.product_quantity.product import (QuantityMixin,
+    QuantityByMixin, clear_locations_cache, get_lazy_fields, in_ids,
+    search_quantities, valid_quantity_clause)
 
 
 class Location(QuantityMixin, metaclass=PoolMeta):
     __name__ = 'stock.location'
+    # The quantity of a location does not depend on the locations context
+    _quantity_parallel = False
+    _location_tree_cache = Cache('stock.location.tree', context=False)
+
+    @classmethod
+    def on_modification(cls, mode, locations, field_names=None):
+        super().on_modification(mode, locations, field_names=field_names)
+        clear_locations_cache()
+        cls._location_tree_cache.clear()
+
+    @classmethod
+    def get_location_tree(cls):
+        """
+        Return a dictionary with the location id as key and its type,
+        warehouse id and the tuple of its ancestor ids (from the parent to
+        the root) as value.
+        """
+        tree = cls._location_tree_cache.get('tree')
+        if tree is not None:
+            return tree
+
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.select(table.id, table.parent, table.type))
+        locations = {i: (p, t) for i, p, t in cursor}
+
+        tree = {}
+        for location_id, (parent_id, type_) in locations.items():
+            ancestors = []
+            while parent_id is not None and parent_id in locations:
+                ancestors.append(parent_id)
+                parent_id = locations[parent_id][0]
+            warehouse_id = next((a for a in [location_id] + ancestors
+                    if locations[a][1] == 'warehouse'), None)
+            tree[location_id] = (type_, warehouse_id, tuple(ancestors))
+        cls._location_tree_cache.set('tree', tree)
+        return tree
+
+    @classmethod
+    def get_quantity(cls, locations, name):
+        context = Transaction().context
+        if name in get_lazy_fields():
+            return dict.fromkeys(map(int, locations))
+        grouping, _, _ = cls._get_quantity_grouping()
+        # With stock_skip_warehouse, products_by_location replaces the
+        # warehouses by their storage location which can not be rolled up
+        if (not grouping or not context.get('with_childs', True)
+                or context.get('stock_skip_warehouse')):
+            return super().get_quantity(locations, name)
+
+        # Compute the quantities of the locations and their descendants
+        # without children and roll them up
+        tree = cls.get_location_tree()
+        location_ids = {l.id for l in locations}
+        rollup = {}
+        for location_id, (_, _, ancestors) in tree.items():
+            parents = location_ids.intersection((location_id,) + ancestors)
+            if parents:
+                rollup[location_id] = parents
+        with Transaction().set_context(with_childs=False):
+            quantities = super().get_quantity(
+                cls.browse(list(rollup)), name)
+
+        res = dict.fromkeys(location_ids, 0)
+        for location_id, quantity in quantities.items():
+            for parent_id in rollup[location_id]:
+                res[parent_id] += quantity or 0
+        return res
+
+    @classmethod
+    def search_quantity(cls, name, domain):
+        grouping, _, _ = cls._get_quantity_grouping()
+        _, operator_, operand = domain
+        if not grouping:
+            return super().search_quantity(name, domain)
+        if not valid_quantity_clause(operator_, operand):
+            return [('id', 'in', [])]
+        return search_quantities(
+            cls.get_quantity(cls.search([]), name), operator_, operand)
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.company, Index.Equality()),
+                (t.product, Index.Range()),
+                (Coalesce(
+                        t.effective_date,
+                        t.planned_date,
+                        datetime.date.max),
+                    Index.Range()),
+                where=t.state == 'draft'))
+
+    @classmethod
+    def on_modification(cls, mode, moves, field_names=None):
+        pool = Pool()
+        Pending = pool.get('product.quantity.pending')
+        Product = pool.get('product.product')
+        Dirty = pool.get('product.quantity.snapshot.dirty')
+        super().on_modification(mode, moves, field_names=field_names)
+        if mode == 'create':
+            if Dirty.enabled():
+                Dirty.add(moves)
+            cls._queue_quantity_snapshot({m.product for m in moves})
+            if Pending.enabled():
+                Pending.refresh({m.product.id for m in moves})
+        if mode in {'create', 'delete'}:
+            Product.clear_available_quantity_cache(
+                [m.product for m in moves if m.state in {'assigned', 'done'}])
+
+    @classmethod
+    def _queue_quantity_snapshot(cls, products):
+        "Queue the refresh of the snapshot of the templates of the products"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Snapshot = pool.get('product.quantity.snapshot')
+        Template = pool.get('product.template')
+        if not Snapshot.queue_enabled() or not products:
+            return
+        templates = {
+            p.template for p in Product.browse(list(map(int, products)))}
+        Template.__queue__.refresh_quantity_snapshot(list(templates))
+
+    @classmethod
+    def _snapshot_fields(cls):
+        "Return the fields that change the quantities of the snapshot"
+        return {
+            'company', 'product', 'from_location', 'to_location', 'state',
+            'quantity', 'unit', 'internal_quantity', 'planned_date',
+            'effective_date'}
+
+    @classmethod
+    def on_write(cls, moves, values):
+        pool = Pool()
+        Pending = pool.get('product.quantity.pending')
+        Product = pool.get('product.product')
+        Dirty = pool.get('product.quantity.snapshot.dirty')
+        callback = super().on_write(moves, values)
+        if values.keys() & cls._snapshot_fields():
+            if Dirty.enabled():
+                Dirty.add(moves)
+            products = {m.product for m in moves}
+            if values.get('product'):
+                products.add(values['product'])
+            cls._queue_quantity_snapshot(products)
+
+            # The available quantity counts the assigned and done moves
+            states = {'assigned', 'done'}
+            if (values.get('state') in states
+                    or any(m.state in states for m in moves)):
+                callback.append(
+                    lambda: Product.clear_available_quantity_cache(products))
+        if Dirty.enabled() and values.keys() & {
+                'company', 'product', 'from_location', 'to_location'}:
+            move_ids = list(map(int, moves))
+            callback.append(lambda: Dirty.add(cls.browse(move_ids)))
+        if Pending.enabled():
+            product_ids = {m.product.id for m in moves}
+            if values.get('product'):
+                product_ids.add(values['product'])
+            callback.append(lambda: Pending.refresh(product_ids))
+        return callback
+
+    @classmethod
+    def on_delete(cls, moves):
+        pool = Pool()
+        Pending = pool.get('product.quantity.pending')
+        Dirty = pool.get('product.quantity.snapshot.dirty')
+        callback = super().on_delete(moves)
+        if Dirty.enabled():
+            Dirty.add(moves)
+        cls._queue_quantity_snapshot({m.product for m in moves})
+        if Pending.enabled():
+            product_ids = {m.product.id for m in moves}
+            callback.append(lambda: Pending.refresh(product_ids))
+        return callback
+
+
+class QuantityPending(ModelSQL):
+    "Product Quantity Pending"
+    __name__ = 'product.quantity.pending'
+    company = fields.Many2One('company.company', "Company", required=True,
+        ondelete='CASCADE')
+    product = fields.Many2One('product.product', "Product", required=True,
+        ondelete='CASCADE')
+    location = fields.Many2One('stock.location', "Location", required=True,
+        ondelete='CASCADE', help="The storage location of the move.")
+    direction = fields.Selection([
+            ('in', "Incoming"),
+            ('out', "Outgoing"),
+            ], "Direction", required=True)
+    date = fields.Date("Date", required=True)
+    quantity = fields.Float("Quantity", required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.company, Index.Equality()),
+                (t.product, Index.Range()),
+                (t.date, Index.Range())))
+
+    @staticmethod
+    def enabled():
+        "Return True if the draft moves summary is maintained"
+        return config.getboolean(
+            'product_quantity', 'pending_summary', default=False)
+
+    @classmethod
+    def _grouping(cls):
+        "Return the move columns by which the summary is grouped"
+        return ['product']
+
+    @classmethod
+    def rebuild(cls):
+        "Rebuild the summary of all the draft moves"
+        cls.refresh()
+
+    @classmethod
+    def refresh(cls, products=None):
+        """
+        Recompute the summary of the draft moves of the products.
+        If products is None, the summary of all the products is recomputed.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        move = Move.__table__()
+        from_location = Location.__table__()
+        to_location = Location.__table__()
+
+        if products is None:
+            cursor.execute(*table.delete())
+            sub_wheres = [Literal(True)]
+        else:
+            product_ids = list(map(int, products))
+            sub_wheres = []
+            for sub_ids in grouped_slice(product_ids):
+                sub_ids = list(sub_ids)
+                cursor.execute(*table.delete(
+                        where=reduce_ids(table.product, sub_ids)))
+                sub_wheres.append(reduce_ids(move.product, sub_ids))
+
+        grouping = cls._grouping()
+        date = Coalesce(
+            move.effective_date, move.planned_date, datetime.date.max)
+        columns = [
+            table.create_uid, table.create_date, table.company,
+            table.location, table.direction, table.date, table.quantity]
+        columns += [Column(table, g) for g in grouping]
+        # The inactive locations are excluded like by _get_in_out_locations
+        active = ((from_location.active == Literal(True))
+            & (to_location.active == Literal(True)))
+        directions = [
+            ('in', move.to_location,
+                (from_location.type == 'supplier')
+                & (to_location.type == 'storage') & active),
+            ('out', move.from_location,
+                (from_location.type == 'storage')
+                & (to_location.type == 'customer') & active),
+            ]
+        for sub_where in sub_wheres:
+            for direction, location, where in directions:
+                group_by = [move.company, location, date]
+                group_by += [Column(move, g) for g in grouping]
+                query = (move
+                    .join(from_location,
+                        condition=move.from_location == from_location.id)
+                    .join(to_location,
+                        condition=move.to_location == to_location.id)
+                    .select(
+                        Literal(transaction.user), CurrentTimestamp(),
+                        move.company, location, Literal(direction), date,
+                        Sum(move.internal_quantity),
+                        *[Column(move, g) for g in grouping],
+                        where=(move.state == 'draft') & where & sub_where,
+                        group_by=group_by))
+                cursor.execute(*table.insert(columns, query))
+
+    @classmethod
+    def get_quantity_query(cls, location_ids, grouping='product',
+            record_ids=None, date_end=None, with_location=False):
+        """
+        Return the query that computes incoming and outgoing quantities
+        grouped by the grouping column (and location) from the summary.
+        """
+        table = cls.__table__()
+        context = Transaction().context
+
+        where = table.company == context.get('company', -1)
+        where &= in_ids(table.location, location_ids)
+        if date_end:
+            where &= table.date <= date_end
+        record = Column(table, grouping)
+        if record_ids:
+            where &= in_ids(record, record_ids)
+        else:
+            where &= record != Null
+        columns = [record.as_('record')]
+        group_by = [record]
+        if with_location:
+            columns.append(table.location.as_('location'))
+            group_by.append(table.location)
+        return table.select(
+            *columns,
+            Sum(Case((table.direction == 'in', table.quantity), else_=0)
+                ).as_('incoming_quantity'),
+            Sum(Case((table.direction == 'out', table.quantity), else_=0)
+                ).as_('outgoing_quantity'),
+            where=where,
+            group_by=group_by)
+
+
+class QuantitySnapshot(ModelSQL):
+    "Product Quantity Snapshot"
+    __name__ = 'product.quantity.snapshot'
+    company = fields.Many2One('company.company', "Company", required=True,
+        ondelete='CASCADE')
+    warehouse = fields.Many2One('stock.location', "Warehouse", required=True,
+        ondelete='CASCADE', domain=[('type', '=', 'warehouse')])
+    product = fields.Many2One('product.product', "Product", required=True,
+        ondelete='CASCADE')
+    available_quantity = fields.Float("Available Quantity", required=True)
+    incoming_quantity = fields.Float("Incoming Quantity", required=True)
+    outgoing_quantity = fields.Float("Outgoing Quantity", required=True)
+    computed_at = fields.Timestamp("Computed At", required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.company, Index.Equality()),
+                    (t.warehouse, Index.Equality()),
+                    (t.product, Index.Range())),
+                Index(
+                    t,
+                    (t.company, Index.Equality()),
+                    (t.warehouse, Index.Equality()),
+                    (t.available_quantity, Index.Range())),
+                })
+
+    @classmethod
+    def refresh(cls, products=None, warehouses=None):
+        """
+        Recompute the quantities of the products in the warehouses.
+        If products is None, the quantities of all the goods are recomputed.
+        If warehouses is None, all the warehouses are recomputed.
+        The quantities are computed for the company of the context or for
+        all the companies.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        company_id = transaction.context.get('company')
+        if company_id:
+            companies = [Company(company_id)]
+        else:
+            companies = Company.search([])
+        if warehouses is None:
+            warehouses = Location.search([('type', '=', 'warehouse')])
+        warehouse_ids = list(map(int, warehouses))
+        if not warehouse_ids:
+            return
+
+        domain = [('type', '=', 'goods')]
+        if products is not None:
+            domain.append(('id', 'in', list(map(int, products))))
+        with transaction.set_context(active_test=False):
+            goods = Product.search(domain, order=[('id', 'ASC')])
+
+        columns = [
+            table.create_uid, table.create_date, table.company,
+            table.warehouse, table.product, table.available_quantity,
+            table.incoming_quantity, table.outgoing_quantity,
+            table.computed_at]
+        for company in companies:
+            where = ((table.company == company.id)
+                & table.warehouse.in_(warehouse_ids))
+            if products is None:
+                cursor.execute(*table.delete(where=where))
+            for sub_products in grouped_slice(goods):
+                sub_products = list(sub_products)
+                if products is not None:
+                    cursor.execute(*table.delete(
+                            where=where
+                            & reduce_ids(table.product, sub_products)))
+                with transaction.set_context(company=company.id,
+                        locations=None, quantity_snapshot=False):
+                    quantities = Product.get_warehouse_quantities(
+                        sub_products, warehouse_ids)
+                now = datetime.datetime.now()
+                values = []
+                for product_id, warehouse_quantities in quantities.items():
+                    for warehouse_id, (available, incoming, outgoing) in (
+                            warehouse_quantities.items()):
+                        if not (available or incoming or outgoing):
+                            continue
+                        values.append([
+                                transaction.user, now, company.id,
+                                warehouse_id, product_id, available,
+                                incoming, outgoing, now])
+                if values:
+                    cursor.execute(*table.insert(columns, values))
+
+    @classmethod
+    def update(cls):
+        """
+        Recompute the quantities of the products and warehouses touched by
+        the moves since the last update.
+
+        The touched keys are only recorded with:
+
+            [product_quantity]
+            snapshot_dirty = True
+        """
+        pool = Pool()
+        Dirty = pool.get('product.quantity.snapshot.dirty')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+
+        transaction = Transaction()
+        company_id = transaction.context.get('company')
+        keys = Dirty.pop(company_id)
+        if not keys:
+            return
+
+        warehouses = Location.search([('type', '=', 'warehouse')])
+        location2warehouse = Product._get_location_warehouses(
+            list(map(int, warehouses)))
+        companies = {}
+        for company_id, product_id, location_id in keys:
+            warehouse_id = location2warehouse.get(location_id)
+            if warehouse_id:
+                products, warehouse_ids = companies.setdefault(
+                    company_id, (set(), set()))
+                products.add(product_id)
+                warehouse_ids.add(warehouse_id)
+        for company_id, (products, warehouse_ids) in companies.items():
+            with transaction.set_context(company=company_id):
+                cls.refresh(sorted(products), sorted(warehouse_ids))
+
+    @classmethod
+    def get_quantities(cls, records, warehouse_ids, names,
+            grouping='product'):
+        """
+        Return the quantities of the records in the warehouses as a
+        dictionary with the field name as key and a dictionary of record id
+        and quantity as value.
+        """
+        cursor = Transaction().connection.cursor()
+
+        record_ids = list(map(int, records))
+        res = dict((n, dict((i, 0.) for i in record_ids)) for n in names)
+        for sub_ids in grouped_slice(record_ids):
+            query = cls.get_quantity_query(
+                warehouse_ids, list(sub_ids), grouping=grouping)
+            cursor.execute(*query.select(
+                    query.record, *[Column(query, n) for n in names]))
+            for record_id, *quantities in cursor:
+                for name, quantity in zip(names, quantities):
+                    res[name][record_id] = quantity or 0.
+        return res
+
+    @classmethod
+    def get_quantity_query(cls, warehouse_ids, record_ids=None,
+            grouping='product'):
+        """
+        Return the query that sums the quantities of the warehouses by
+        product or by template (depending on grouping) in the record column.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        table = cls.__table__()
+        context = Transaction().context
+
+        if grouping == 'template':
+            product = Product.__table__()
+            from_ = table.join(product,
+                condition=table.product == product.id)
+            record = product.template
+        else:
+            from_ = table
+            record = table.product
+
+        where = table.company == context.get('company', -1)
+        where &= table.warehouse.in_(warehouse_ids)
+        if record_ids is not None:
+            where &= reduce_ids(record, record_ids)
+        return from_.select(
+            record.as_('record'),
+            Sum(table.available_quantity).as_('available_quantity'),
+            Sum(table.incoming_quantity).as_('incoming_quantity'),
+            Sum(table.outgoing_quantity).as_('outgoing_quantity'),
+            where=where,
+            group_by=[record])
+
+    @staticmethod
+    def queue_enabled():
+        "Return True if the snapshot is refreshed by the queue on move changes"
+        return config.getboolean(
+            'product_quantity', 'snapshot_queue', default=False)
+
+
+class QuantitySnapshotDirty(ModelSQL):
+    "Product Quantity Snapshot Dirty Key"
+    __name__ = 'product.quantity.snapshot.dirty'
+    company = fields.Many2One('company.company', "Company", required=True,
+        ondelete='CASCADE')
+    product = fields.Many2One('product.product', "Product", required=True,
+        ondelete='CASCADE')
+    location = fields.Many2One('stock.location', "Location", required=True,
+        ondelete='CASCADE')
+
+    @staticmethod
+    def enabled():
+        "Return True if the keys changed by the moves are recorded"
+        return config.getboolean(
+            'product_quantity', 'snapshot_dirty', default=False)
+
+    @classmethod
+    def add(cls, moves):
+        "Record the keys of the moves as changed"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        keys = set()
+        for move in moves:
+            for location in [move.from_location, move.to_location]:
+                keys.add((move.company.id, move.product.id, location.id))
+        if not keys:
+            return
+        now = datetime.datetime.now()
+        columns = [
+            table.create_uid, table.create_date,
+            table.company, table.product, table.location]
+        for sub_keys in grouped_slice(sorted(keys)):
+            cursor.execute(*table.insert(columns, [
+                        [transaction.user, now, *k] for k in sub_keys]))
+
+    @classmethod
+    def pop(cls, company_id=None):
+        """
+        Remove the changed keys of the company (or of all the companies) and
+        return them as a set of (company, product, location).
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        where = Literal(True)
+        if company_id:
+            where = table.company == company_id
+        cursor.execute(*table.select(Max(table.id), where=where))
+        last_id, = cursor.fetchone()
+        if last_id is None:
+            return set()
+        where &= table.id <= last_id
+        cursor.execute(*table.select(
+                table.company, table.product, table.location,
+                where=where,
+                group_by=[table.company, table.product, table.location]))
+        keys = set(map(tuple, cursor))
+        cursor.execute(*table.delete(where=where))
+        return keys
+
+
+class QuantityPendingLot(metaclass=PoolMeta):
+    __name__ = 'product.quantity.pending'
+    lot = fields.Many2One('stock.lot', "Lot", ondelete='CASCADE')
+
+    @classmethod
+    def _grouping(cls):
+        return super()._grouping() + ['lot']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('product.quantity.pending|rebuild',
+                "Rebuild Pending Product Quantities"))
+        cls.method.selection.append(
+            ('product.quantity.snapshot|refresh',
+                "Refresh Product Quantity Snapshot"))
+        cls.method.selection.append(
+            ('product.quantity.snapshot|update',
+                "Update Product Quantity Snapshot"))
 
 
 class Lot(QuantityMixin, QuantityByMixin, metaclass=PoolMeta):
     __name__ = 'stock.lot'
 
+    @classmethod
+    def _quantity_grouping(cls):
+        return ('product', 'lot')
+
+    @classmethod
+    def _quantity_grouping_filter(cls, lots):
+        return (list(set(l.product.id for l in lots)),)
+
+    @classmethod
+    def _in_out_grouping(cls):
+        return 'lot'
+
 
 class ProductsByLocations(metaclass=PoolMeta):
     __name__ = 'stock.products_by_locations'
     available_quantity = fields.Function(fields.Float('Available Quantity'),
-        'get_product', searcher='search_product')
+        'get_quantities', searcher='search_product')
     incoming_quantity = fields.Function(fields.Float('Incoming Quantity'),
-        'get_product', searcher='search_product')
+        'get_quantities', searcher='search_product')
     outgoing_quantity = fields.Function(fields.Float('Outgoing Quantity'),
-        'get_product', searcher='search_product')
+        'get_quantities', searcher='search_product')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.quantity.getter = 'get_quantities'
+        cls.forecast_quantity.getter = 'get_quantities'
+
+    @classmethod
+    def get_quantities(cls, records, names):
+        "Compute the quantities of the products of all the rows together"
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        products = Product.browse(list({r.product.id for r in records}))
+        quantities = Product.get_quantities(products, names)
+        return {n: {r.id: quantities[n][r.product.id] for r in records}
+            for n in names}
 
 
 class LotsByLocations(metaclass=PoolMeta):
     __name__ = 'stock.lots_by_locations'
     available_quantity = fields.Function(fields.Float('Available Quantity'),
-        'get_lot', searcher='search_lot')
+        'get_quantities', searcher='search_lot')
     incoming_quantity = fields.Function(fields.Float('Incoming Quantity'),
-        'get_lot', searcher='search_lot')
+        'get_quantities', searcher='search_lot')
     outgoing_quantity = fields.Function(fields.Float('Outgoing Quantity'),
-        'get_lot', searcher='search_lot')
+        'get_quantities', searcher='search_lot')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.quantity.getter = 'get_quantities'
+        cls.forecast_quantity.getter = 'get_quantities'
+
+    @classmethod
+    def get_quantities(cls, records, names):
+        "Compute the quantities of the lots of all the rows together"
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+
+        lots = Lot.browse(list({r.lot.id for r in records}))
+        quantities = Lot.get_quantities(lots, names)
+        return {n: {r.id: quantities[n][r.lot.id] for r in records}
+            for n in names}
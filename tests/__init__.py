@@ -1,6 +1,3 @@
 # This file is part product_quantity module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from .test_product_quantity import suite
-
-__all__ = ['suite']
@@ -0,0 +1,17 @@
+# This file is part product_quantity module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Benchmark of the product quantity getters and searchers.
+
+Run it with:
+
+    python -m trytond.modules.product_quantity.tests.benchmark --help
+
+The database is selected like for the tests, with the DB_NAME environment
+variable and the trytond configuration.
+"""
+from .data import generate
+from .run import run
+
+__all__ = ['generate', 'run']
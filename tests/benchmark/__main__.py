@@ -0,0 +1,68 @@
+# This file is part product_quantity module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import argparse
+import json
+import sys
+
+from trytond.tests.test_tryton import DB_NAME, USER, activate_module
+from trytond.transaction import Transaction
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m trytond.modules.product_quantity.tests.benchmark',
+        description="Benchmark the product quantity fields")
+    parser.add_argument('--warehouses', type=int, default=1)
+    parser.add_argument('--locations', type=int, default=10,
+        help="number of nested storage locations per warehouse")
+    parser.add_argument('--products', type=int, default=100,
+        help="number of product templates")
+    parser.add_argument('--variants', type=int, default=1,
+        help="number of variants per template")
+    parser.add_argument('--lots', type=int, default=0,
+        help="number of lots per variant (requires stock_lot)")
+    parser.add_argument('--moves', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', default='-',
+        help="file to write the JSON results to")
+    args = parser.parse_args()
+
+    from trytond.modules.company.tests import create_company, set_company
+    from .data import generate
+    from .run import run
+
+    modules = ['product_quantity']
+    if args.lots:
+        modules.append('stock_lot')
+    activate_module(modules)
+    with Transaction().start(DB_NAME, USER) as transaction:
+        company = create_company()
+        with set_company(company):
+            records = generate(
+                warehouses=args.warehouses, locations=args.locations,
+                products=args.products, variants=args.variants,
+                lots=args.lots, moves=args.moves, seed=args.seed)
+            results = run(
+                records['templates'], records['products'],
+                repeat=args.repeat)
+        transaction.rollback()
+
+    parameters = vars(args).copy()
+    del parameters['output']
+    data = {
+        'parameters': parameters,
+        'database': DB_NAME,
+        'results': results,
+        }
+    if args.output == '-':
+        json.dump(data, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(data, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# This file is part product_quantity module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import datetime
+import random
+from decimal import Decimal
+
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+
+def _create(Model, vlist):
+    records = []
+    for sub_vlist in grouped_slice(vlist):
+        records.extend(Model.create(list(sub_vlist)))
+    return records
+
+
+def _create_warehouses(warehouses, locations, rng):
+    "Create the warehouses with their nested storage locations"
+    pool = Pool()
+    Location = pool.get('stock.location')
+
+    storage_ids = []
+    for i in range(warehouses):
+        input_, output, storage = Location.create([{
+                    'name': 'Input %s' % i,
+                    'type': 'storage',
+                    }, {
+                    'name': 'Output %s' % i,
+                    'type': 'storage',
+                    }, {
+                    'name': 'Storage %s' % i,
+                    'type': 'storage',
+                    }])
+        Location.create([{
+                    'name': 'Warehouse %s' % i,
+                    'code': 'BWH%s' % i,
+                    'type': 'warehouse',
+                    'input_location': input_.id,
+                    'output_location': output.id,
+                    'storage_location': storage.id,
+                    }])
+        parents = [storage]
+        for j in range(locations):
+            location, = Location.create([{
+                        'name': 'Bin %s-%s' % (i, j),
+                        'type': 'storage',
+                        'parent': rng.choice(parents).id,
+                        }])
+            parents.append(location)
+        storage_ids.extend(p.id for p in parents)
+    return storage_ids
+
+
+def _create_products(products, variants):
+    pool = Pool()
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    templates = _create(Template, [{
+                'name': 'Product %s' % i,
+                'type': 'goods',
+                'default_uom': unit.id,
+                'products': [('create', [{}] * variants)],
+                } for i in range(products)])
+    return templates, [p for t in templates for p in t.products]
+
+
+def _create_lots(products, lots):
+    pool = Pool()
+    try:
+        Lot = pool.get('stock.lot')
+    except KeyError:
+        return {}
+    records = _create(Lot, [{
+                'number': '%s-%s' % (p.id, i),
+                'product': p.id,
+                } for p in products for i in range(lots)])
+    product2lots = {}
+    for lot in records:
+        product2lots.setdefault(lot.product.id, []).append(lot.id)
+    return product2lots
+
+
+def _create_moves(products, storage_ids, product2lots, moves, rng):
+    pool = Pool()
+    Company = pool.get('company.company')
+    Date = pool.get('ir.date')
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+
+    company = Company(Transaction().context['company'])
+    supplier, = Location.search([('code', '=', 'SUP')])
+    customer, = Location.search([('code', '=', 'CUS')])
+    today = Date.today()
+
+    vlist, states = [], []
+    for _ in range(moves):
+        product = rng.choice(products)
+        state = rng.choice(['draft', 'assigned', 'done'])
+        if state == 'done':
+            date = today - datetime.timedelta(days=rng.randint(0, 365))
+        else:
+            date = today + datetime.timedelta(days=rng.randint(0, 365))
+        storage_id = rng.choice(storage_ids)
+        if rng.random() < 0.5:
+            from_location, to_location = supplier.id, storage_id
+        else:
+            from_location, to_location = storage_id, customer.id
+        values = {
+            'product': product.id,
+            'unit': product.default_uom.id,
+            'quantity': float(rng.randint(1, 100)),
+            'from_location': from_location,
+            'to_location': to_location,
+            'planned_date': date,
+            'company': company.id,
+            'unit_price': Decimal(1),
+            'currency': company.currency.id,
+            }
+        if product2lots.get(product.id):
+            values['lot'] = rng.choice(product2lots[product.id])
+        vlist.append(values)
+        states.append(state)
+
+    records = _create(Move, vlist)
+    Move.assign([m for m, s in zip(records, states) if s == 'assigned'])
+    Move.do([m for m, s in zip(records, states) if s == 'done'])
+    return records
+
+
+def generate(warehouses=1, locations=10, products=100, variants=1, lots=0,
+        moves=1000, seed=0):
+    """
+    Generate a synthetic dataset in the current transaction.
+
+    The company must be set in the context.
+    Return the dictionary of the created templates and products.
+    """
+    rng = random.Random(seed)
+    storage_ids = _create_warehouses(warehouses, locations, rng)
+    templates, products_ = _create_products(products, variants)
+    product2lots = _create_lots(products_, lots) if lots else {}
+    _create_moves(products_, storage_ids, product2lots, moves, rng)
+    return {
+        'templates': templates,
+        'products': products_,
+        }
@@ -0,0 +1,48 @@
+# This file is part product_quantity module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import statistics
+import time
+
+from trytond.pool import Pool
+
+
+def _timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        'min': min(timings),
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+        }
+
+
+def run(templates, products, repeat=5):
+    """
+    Time the quantity getters and searchers on the records.
+
+    Return a dictionary with the name of the benchmark as key and the
+    timings in seconds as value.
+    """
+    pool = Pool()
+    Product = pool.get('product.product')
+    Template = pool.get('product.template')
+
+    in_out_names = ['incoming_quantity', 'outgoing_quantity']
+    names = ['available_quantity'] + in_out_names
+    benchmarks = {
+        'get_quantity': lambda: Product.get_quantity(
+            products, 'available_quantity'),
+        'get_in_out_quantities': lambda: Product.get_in_out_quantities(
+            products, in_out_names),
+        'search_quantity': lambda: Product.search(
+            [('available_quantity', '>', 0)]),
+        'search_in_out_quantity': lambda: Product.search(
+            [('incoming_quantity', '>', 0)]),
+        'template_get_product_quantity': (
+            lambda: Template.get_product_quantity(templates, names)),
+        }
+    return {name: _timeit(func, repeat) for name, func in benchmarks.items()}
@@ -1,7 +1,22 @@
 # This file is part product_quantity module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from trytond import config
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.product_quantity import instrument, parallel
+from trytond.modules.product_quantity import product as product_module
+from trytond.modules.product_quantity.product import (
+    match_quantities, search_quantities, valid_quantity_clause)
+from trytond.modules.product_quantity.stock import (
+    QuantityPending, QuantitySnapshotDirty)
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 
 class ProductQuantityTestCase(ModuleTestCase):
@@ -9,4 +24,1050 @@ class ProductQuantityTestCase(ModuleTestCase):
     module = 'product_quantity'
     extras = ['stock_lot']
 
+    def _create_warehouse_moves(self, company):
+        """
+        Create a product with done and draft moves in two warehouses and
+        return the product and the warehouses.
+        """
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Product',
+                    'type': 'goods',
+                    'default_uom': unit.id,
+                    'products': [('create', [{}])],
+                    }])
+        product, = template.products
+        supplier, = Location.search([('code', '=', 'SUP')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        warehouse1, = Location.search([('code', '=', 'WH')])
+        warehouse2, = Location.copy([warehouse1])
+
+        def move(from_, to, quantity):
+            return {
+                'product': product.id,
+                'unit': unit.id,
+                'quantity': quantity,
+                'from_location': from_.id,
+                'to_location': to.id,
+                'company': company.id,
+                'unit_price': Decimal(1),
+                'currency': company.currency.id,
+                }
+        moves = Move.create([
+                move(supplier, warehouse1.storage_location, 10),
+                move(supplier, warehouse2.storage_location, 5),
+                ])
+        Move.do(moves)
+        Move.create([
+                move(supplier, warehouse1.storage_location, 3),
+                move(warehouse2.storage_location, customer, 2),
+                ])
+        return product, warehouse1, warehouse2
+
+    @with_transaction()
+    def test_warehouse_quantities(self):
+        "Test quantities by warehouse"
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        company = create_company()
+        with set_company(company):
+            product, warehouse1, warehouse2 = self._create_warehouse_moves(
+                company)
+
+            self.assertEqual(
+                Product.get_warehouse_quantities(
+                    [product], [warehouse1, warehouse2]),
+                {
+                    product.id: {
+                        warehouse1.id: (10, 3, 0),
+                        warehouse2.id: (5, 0, 2),
+                        },
+                    })
+
+    @with_transaction()
+    def test_export_quantities(self):
+        "Test export of quantities"
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        company = create_company()
+        with set_company(company):
+            product, _, _ = self._create_warehouse_moves(company)
+
+            self.assertEqual(
+                list(Product.export_quantities(chunk_size=1)),
+                [(product.id, product.code, 15, 3, 2)])
+
+            # The lazy fields do not apply to the export
+            if not config.has_section('product_quantity'):
+                config.add_section('product_quantity')
+            config.set('product_quantity', 'lazy_fields',
+                'incoming_quantity, outgoing_quantity')
+            try:
+                with Transaction().set_context(quantity_lazy_fields=[
+                            'available_quantity', 'incoming_quantity',
+                            'outgoing_quantity']):
+                    self.assertEqual(
+                        list(Product.export_quantities()),
+                        [(product.id, product.code, 15, 3, 2)])
+                self.assertEqual(
+                    Product.get_in_out_quantity(
+                        [product], 'incoming_quantity'),
+                    {product.id: 3})
+            finally:
+                config.set('product_quantity', 'lazy_fields', '')
+
+    @with_transaction()
+    def test_location_quantity(self):
+        "Test quantities of locations"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            product, warehouse1, warehouse2 = self._create_warehouse_moves(
+                company)
+            supplier, = Location.search([('code', '=', 'SUP')])
+            customer, = Location.search([('code', '=', 'CUS')])
+
+            with Transaction().set_context(product=product.id):
+                self.assertEqual(
+                    Location.get_quantity(Location.browse([
+                                warehouse1, warehouse1.storage_location,
+                                warehouse2, customer]), 'quantity'),
+                    {
+                        warehouse1.id: 10,
+                        warehouse1.storage_location.id: 10,
+                        warehouse2.id: 5,
+                        customer.id: 0,
+                        })
+                self.assertEqual(
+                    Location.search([
+                            ('type', '=', 'warehouse'),
+                            ('quantity', '>=', 10),
+                            ]),
+                    [warehouse1])
+
+            # The input zone is not in the warehouse quantity when the
+            # warehouse is replaced by its storage zone
+            Move.do(Move.create([{
+                            'product': product.id,
+                            'unit': product.default_uom.id,
+                            'quantity': 5,
+                            'from_location': supplier.id,
+                            'to_location': warehouse1.input_location.id,
+                            'company': company.id,
+                            'unit_price': Decimal(1),
+                            'currency': company.currency.id,
+                            }]))
+            with Transaction().set_context(
+                    product=product.id, stock_skip_warehouse=True):
+                self.assertEqual(
+                    Location.get_quantity([warehouse1], 'quantity'),
+                    {warehouse1.id: 10})
+            with Transaction().set_context(product=product.id,
+                    quantity_lazy_fields=['quantity']):
+                self.assertEqual(
+                    Location.get_quantity([warehouse1], 'quantity'),
+                    {warehouse1.id: None})
+
+    @with_transaction()
+    def test_search_quantity(self):
+        "Test search on quantities"
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        company = create_company()
+        with set_company(company):
+            product, _, _ = self._create_warehouse_moves(company)
+
+            self.assertEqual(
+                Product.search([
+                        ('quantity', '>=', 10),
+                        ('quantity', '<=', 20),
+                        ]),
+                [product])
+            self.assertEqual(
+                Product.search([('quantity', 'not in', [15])]), [])
+            self.assertEqual(
+                Product.search([('incoming_quantity', 'in', [1, 2])]), [])
+            self.assertEqual(
+                Product.search([('outgoing_quantity', 'in', [1, 2])]),
+                [product])
+
+    @with_transaction()
+    def test_read_quantities(self):
+        "Test reading the quantity fields together"
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        company = create_company()
+        with set_company(company):
+            product, _, _ = self._create_warehouse_moves(company)
+
+            quantity, = Product.read([product.id], [
+                    'quantity', 'forecast_quantity', 'available_quantity',
+                    'incoming_quantity', 'outgoing_quantity'])
+            self.assertEqual(quantity, {
+                    'id': product.id,
+                    'quantity': 15,
+                    'forecast_quantity': 16,
+                    'available_quantity': 15,
+                    'incoming_quantity': 3,
+                    'outgoing_quantity': 2,
+                    })
+            self.assertEqual(
+                Product.get_in_out_quantity([product], 'incoming_quantity'),
+                {product.id: 3})
+
+    @with_transaction()
+    def test_lazy_fields(self):
+        "Test lazy quantity fields"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        company = create_company()
+        with set_company(company):
+            product, _, _ = self._create_warehouse_moves(company)
+            template = product.template
+
+            with Transaction().set_context(
+                    quantity_lazy_fields=['incoming_quantity']):
+                self.assertEqual(
+                    Product.get_in_out_quantities(
+                        [product], ['incoming_quantity', 'outgoing_quantity']),
+                    {
+                        'incoming_quantity': {product.id: None},
+                        'outgoing_quantity': {product.id: 2},
+                        })
+                self.assertEqual(
+                    Template.get_product_quantity(
+                        [template], ['available_quantity',
+                            'incoming_quantity']),
+                    {
+                        'available_quantity': {template.id: 15},
+                        'incoming_quantity': {template.id: None},
+                        })
+
+    @with_transaction()
+    def test_available_quantity_cache(self):
+        "Test the cache of available quantity is cleared by product"
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            configuration = Configuration(1)
+            configuration.available_quantity_cache = 3600
+            configuration.save()
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}]), ('create', [{}])],
+                        }])
+            product1, product2 = template.products
+            supplier, = Location.search([('code', '=', 'SUP')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            def move(product, from_, to, quantity):
+                return {
+                    'product': product.id,
+                    'unit': unit.id,
+                    'quantity': quantity,
+                    'from_location': from_.id,
+                    'to_location': to.id,
+                    'company': company.id,
+                    'unit_price': Decimal(1),
+                    'currency': company.currency.id,
+                    }
+
+            def available_quantities():
+                return Product.get_quantity(
+                    [product1, product2], 'available_quantity')
+
+            Move.do(Move.create([
+                        move(product1, supplier, storage, 10),
+                        move(product2, supplier, storage, 10),
+                        ]))
+            self.assertEqual(
+                available_quantities(), {product1.id: 10, product2.id: 10})
+
+            def generations():
+                return [Product._available_quantity_generation.get(p.id)
+                    for p in [product1, product2]]
+
+            generation1, generation2 = generations()
+            out, = Move.create([move(product1, storage, customer, 3)])
+            Move.assign([out])
+            self.assertEqual(
+                available_quantities(), {product1.id: 7, product2.id: 10})
+            self.assertEqual(generations(), [generation1 + 1, generation2])
+
+            Move.write([out], {
+                    'planned_date': datetime.date.today()
+                    + datetime.timedelta(days=10),
+                    })
+            self.assertEqual(generations(), [generation1 + 2, generation2])
+
+            Move.draft([out])
+            Move.write([out], {'quantity': 4, 'product': product2.id})
+            Move.assign([out])
+            self.assertEqual(
+                available_quantities(), {product1.id: 10, product2.id: 6})
+
+    @with_transaction()
+    def test_profile(self):
+        "Test the profile of the quantity getters"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}])],
+                        }])
+            product, = template.products
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            Move.create([{
+                        'product': product.id,
+                        'unit': unit.id,
+                        'quantity': 5,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        }])
+
+            key = 'product.product.get_quantities'
+            before = instrument.summary().get(key, {})
+            with Transaction().set_context(product_quantity_profile=True):
+                quantity, = Product.read([product.id], [
+                        'quantity', 'incoming_quantity'])
+            after = instrument.summary()[key]
+
+            self.assertEqual(quantity['incoming_quantity'], 5)
+            self.assertEqual(after['calls'] - before.get('calls', 0), 1)
+            self.assertEqual(after['records'] - before.get('records', 0), 1)
+            for name in ['queries', 'rows']:
+                with self.subTest(name=name):
+                    self.assertGreater(after[name], before.get(name, 0))
+            for name in ['time', 'time:_quantity_locations',
+                    'time:_get_in_out_quantity', 'time:get_quantity']:
+                with self.subTest(name=name):
+                    self.assertGreater(after[name], before.get(name, 0))
+
+            # The cursor of the connection is restored
+            self.assertNotIn(
+                'cursor', getattr(Transaction().connection, '__dict__', {}))
+
+    def _test_match_quantities(self):
+        quantities = {1: 0, 2: 1.5, 3: 5, 4: None}
+        for operator_, operand, ids in [
+                ('=', 5, [3]),
+                ('!=', 0, [2, 3]),
+                ('<', 1.5, [1, 4]),
+                ('>=', 1.5, [2, 3]),
+                ('in', [0, 5], [1, 3, 4]),
+                ('in', [], []),
+                ('not in', [1.5], [1, 3, 4]),
+                ('not in', [], [1, 2, 3, 4]),
+                ('=', None, []),
+                ('!=', None, []),
+                ('in', [None, 5], []),
+                ('not in', [None], []),
+                ('like', '5', []),
+                ]:
+            with self.subTest(operator=operator_, operand=operand):
+                self.assertEqual(
+                    search_quantities(quantities, operator_, operand),
+                    [('id', 'in', ids)])
+                if valid_quantity_clause(operator_, operand):
+                    self.assertEqual(
+                        list(match_quantities(
+                                [0, 1.5, 5], operator_, operand)),
+                        [i in ids for i in [1, 2, 3]])
+
+    def test_match_quantities(self):
+        "Test matching quantities without numpy"
+        with patch.object(product_module, 'numpy', None):
+            self._test_match_quantities()
+
+    @unittest.skipUnless(product_module.numpy, "numpy is not installed")
+    def test_match_quantities_numpy(self):
+        "Test matching quantities with numpy"
+        self._test_match_quantities()
+
+    @with_transaction()
+    def test_parallel_quantity_read(self):
+        "Test reading the quantities uses the partitions of the warehouses"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}])],
+                        }])
+            product, = template.products
+            supplier, = Location.search([('code', '=', 'SUP')])
+            warehouse1, = Location.search([('code', '=', 'WH')])
+            warehouse2, = Location.copy([warehouse1])
+
+            moves = Move.create([{
+                        'product': product.id,
+                        'unit': unit.id,
+                        'quantity': quantity,
+                        'from_location': supplier.id,
+                        'to_location': warehouse.storage_location.id,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        } for warehouse, quantity in [
+                        (warehouse1, 10), (warehouse2, 5)]])
+            Move.do(moves)
+
+            partitions = []
+
+            def run(func, partitions_):
+                partitions.extend(partitions_)
+                return [func(p) for p in partitions_]
+
+            with patch.object(parallel, 'workers', lambda: 2), \
+                    patch.object(parallel, 'run', run):
+                quantity, = Product.read([product.id], ['quantity'])
+
+            self.assertEqual(quantity['quantity'], 15)
+            self.assertEqual(len(partitions), 2)
+
+    @with_transaction()
+    def test_parallel_quantity_partitions(self):
+        "Test the sum of the partitions of the warehouses"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}]), ('create', [{}])],
+                        }])
+            product1, product2 = template.products
+            supplier, = Location.search([('code', '=', 'SUP')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            warehouse1, = Location.search([('code', '=', 'WH')])
+            warehouse2, warehouse3 = Location.copy([warehouse1, warehouse1])
+
+            def move(product, from_, to, quantity):
+                return {
+                    'product': product.id,
+                    'unit': unit.id,
+                    'quantity': quantity,
+                    'from_location': from_.id,
+                    'to_location': to.id,
+                    'company': company.id,
+                    'unit_price': Decimal(1),
+                    'currency': company.currency.id,
+                    }
+            moves = Move.create([
+                    move(product1, supplier, warehouse1.storage_location, 10),
+                    move(product1, supplier, warehouse2.storage_location, 5),
+                    move(product2, supplier, warehouse3.storage_location, 7),
+                    ])
+            Move.do(moves)
+            Move.create([
+                    move(product1, warehouse1.storage_location, customer, 4),
+                    move(product2, supplier, warehouse2.storage_location, 2),
+                    ])
+
+            warehouses = [warehouse1, warehouse2, warehouse3]
+            products = [product1, product2]
+            partitions = []
+
+            def run(func, partitions_):
+                partitions.extend(partitions_)
+                return [func(p) for p in partitions_]
+
+            for name in ['quantity', 'forecast_quantity']:
+                with self.subTest(name=name):
+                    del partitions[:]
+                    with Transaction().set_context(
+                            Product._quantity_context(name)):
+                        pbl = Product.products_by_location(
+                            [w.id for w in warehouses],
+                            with_childs=True,
+                            grouping_filter=([p.id for p in products],))
+                    with patch.object(parallel, 'workers', lambda: 2), \
+                            patch.object(parallel, 'run', run):
+                        quantities = Product.get_quantity(products, name)
+
+                    self.assertEqual(len(partitions), 2)
+                    self.assertEqual(quantities, {
+                            p.id: sum(pbl.get((w.id, p.id), 0)
+                                for w in warehouses)
+                            for p in products})
+
+    @with_transaction()
+    def test_availability_series(self):
+        "Test available quantity by day"
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}]), ('create', [{}])],
+                        }])
+            product, product2 = template.products
+            supplier, = Location.search([('code', '=', 'SUP')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            storage, = Location.search([('code', '=', 'STO')])
+            today = Date.today()
+
+            def day(days):
+                return today + datetime.timedelta(days=days)
+
+            moves = Move.create([{
+                        'product': product.id,
+                        'unit': unit.id,
+                        'quantity': quantity,
+                        'from_location': from_.id,
+                        'to_location': to.id,
+                        'planned_date': date,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        } for quantity, from_, to, date in [
+                        (10, supplier, storage, today),
+                        (1, supplier, storage, today),
+                        (5, supplier, storage, day(2)),
+                        (3, storage, customer, day(4)),
+                        (7, storage, customer, day(9)),
+                        (2, supplier, storage, day(-1)),
+                        ]] + [{
+                        'product': product2.id,
+                        'unit': unit.id,
+                        'quantity': 4,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'planned_date': day(3),
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        }])
+            Move.do(moves[:1])
+
+            series = Product.get_availability_series([product], day(5))
+
+            self.assertEqual(series, {
+                    product.id: [
+                        (today, 10),
+                        (day(1), 11),
+                        (day(2), 16),
+                        (day(3), 16),
+                        (day(4), 13),
+                        (day(5), 13),
+                        ],
+                    })
+            self.assertEqual(
+                Product.get_availability_series(
+                    [product], day(9), date_start=day(3))[product.id],
+                [(day(3), 16), (day(4), 13), (day(5), 13), (day(6), 13),
+                    (day(7), 13), (day(8), 13), (day(9), 6)])
+
+            for date, quantity in series[product.id]:
+                with Transaction().set_context(
+                        stock_date_end=date, stock_assign=True):
+                    self.assertEqual(
+                        Product.products_by_location(
+                            [storage.id], with_childs=True,
+                            grouping_filter=([product.id],)).get(
+                            (storage.id, product.id), 0),
+                        quantity)
+
+            # The products are queried by slice of ids on SQLite
+            with patch.object(Transaction().database, 'IN_MAX', 1):
+                self.assertEqual(
+                    Product.get_availability_series(
+                        [product, product2], day(5)),
+                    {
+                        product.id: series[product.id],
+                        product2.id: [
+                            (today, 0), (day(1), 0), (day(2), 0),
+                            (day(3), 4), (day(4), 4), (day(5), 4)],
+                        })
+
+    @with_transaction()
+    def test_template_search_quantity(self):
+        "Test searching templates by the quantities of their variants"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template1, template2 = Template.create([{
+                        'name': 'Product 1',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}, {}])],
+                        }, {
+                        'name': 'Product 2',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}])],
+                        }])
+            product1, product2 = template1.products
+            product3, = template2.products
+            supplier, = Location.search([('code', '=', 'SUP')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            warehouse1, = Location.search([('code', '=', 'WH')])
+            warehouse2, = Location.copy([warehouse1])
+
+            def move(product, from_, to, quantity):
+                return {
+                    'product': product.id,
+                    'unit': unit.id,
+                    'quantity': quantity,
+                    'from_location': from_.id,
+                    'to_location': to.id,
+                    'company': company.id,
+                    'unit_price': Decimal(1),
+                    'currency': company.currency.id,
+                    }
+            Move.do(Move.create([
+                        move(product1, supplier,
+                            warehouse1.storage_location, 4),
+                        move(product2, supplier,
+                            warehouse2.storage_location, 3),
+                        move(product3, supplier,
+                            warehouse1.storage_location, 5),
+                        ]))
+            Move.create([
+                    move(product1, supplier, warehouse2.storage_location, 2),
+                    move(product2, supplier, warehouse1.storage_location, 1),
+                    move(product3, warehouse1.storage_location, customer, 2),
+                    ])
+
+            for domain, result in [
+                    (('available_quantity', '=', 7), [template1]),
+                    (('available_quantity', '>=', 5), [template1, template2]),
+                    (('available_quantity', 'in', [5, 6]), [template2]),
+                    (('incoming_quantity', '=', 3), [template1]),
+                    (('incoming_quantity', '=', 0), [template2]),
+                    (('outgoing_quantity', '>', 0), [template2]),
+                    ]:
+                with self.subTest(domain=domain):
+                    self.assertEqual(
+                        Template.search([domain], order=[('id', 'ASC')]),
+                        result)
+
+            for order, result in [
+                    ([('available_quantity', 'DESC')], [template1, template2]),
+                    ([('incoming_quantity', 'ASC')], [template2, template1]),
+                    ([('outgoing_quantity', 'DESC')], [template2, template1]),
+                    ]:
+                with self.subTest(order=order):
+                    self.assertEqual(
+                        Template.search([
+                                ('id', 'in', [template1.id, template2.id]),
+                                ], order=order),
+                        result)
+
+            with Transaction().set_context(locations=[warehouse1.id]):
+                for domain, result in [
+                        (('available_quantity', '=', 4), [template1]),
+                        (('available_quantity', '>', 4), [template2]),
+                        (('incoming_quantity', '=', 1), [template1]),
+                        ]:
+                    with self.subTest(domain=domain, locations='warehouse1'):
+                        self.assertEqual(
+                            Template.search(
+                                [domain], order=[('id', 'ASC')]),
+                            result)
+
+    @with_transaction()
+    @patch.object(QuantitySnapshotDirty, 'enabled', staticmethod(lambda: True))
+    def test_quantity_snapshot(self):
+        "Test reading quantities from the snapshot"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Snapshot = pool.get('product.quantity.snapshot')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}, {}])],
+                        }])
+            product1, product2 = template.products
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            moves = Move.create([{
+                        'product': product.id,
+                        'unit': unit.id,
+                        'quantity': quantity,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        } for product, quantity in [
+                        (product1, 7), (product2, 2), (product2, 4)]])
+            Move.do(moves[:2])
+            Snapshot.refresh()
+            # Not seen by the snapshot until the next refresh
+            Move.do(moves[2:])
+
+            with Transaction().set_context(quantity_snapshot=True):
+                products = Product.browse([product1, product2])
+                self.assertEqual(
+                    [p.available_quantity for p in products], [7, 2])
+                self.assertEqual(
+                    [p.incoming_quantity for p in products], [0, 4])
+                self.assertEqual(
+                    Product.search([('available_quantity', '>', 5)]),
+                    [product1])
+                self.assertEqual(
+                    Product.search([], order=[('available_quantity', 'ASC')]),
+                    [product2, product1])
+                self.assertEqual(
+                    Template.read([template.id], [
+                            'available_quantity', 'incoming_quantity']),
+                    [{
+                            'id': template.id,
+                            'available_quantity': 9,
+                            'incoming_quantity': 4,
+                            }])
+                self.assertEqual(
+                    Template.search([
+                            ('available_quantity', '=', 9),
+                            ], order=[('available_quantity', 'DESC')]),
+                    [template])
+            self.assertEqual(
+                Product(product2.id).available_quantity, 6)
+            # Without the snapshot the order is computed from the moves
+            self.assertEqual(
+                Product.search([], order=[('available_quantity', 'ASC')]),
+                [product2, product1])
+            self.assertEqual(
+                Product.search([], order=[('available_quantity', 'DESC')]),
+                [product1, product2])
+
+            Snapshot.update()
+            with Transaction().set_context(quantity_snapshot=True):
+                products = Product.browse([product1, product2])
+                self.assertEqual(
+                    [p.available_quantity for p in products], [7, 6])
+                self.assertEqual(
+                    [p.incoming_quantity for p in products], [0, 0])
+
+            Move.do(Move.copy(moves[:1]))
+            Template.refresh_quantity_snapshot([template])
+            with Transaction().set_context(quantity_snapshot=True):
+                self.assertEqual(
+                    Template(template.id).available_quantity, 20)
+            self.assertEqual(
+                Template.search([('available_quantity', '>', 15)]),
+                [template])
+
+    @with_transaction()
+    def test_in_out_quantity_slices(self):
+        "Test incoming and outgoing quantities by slice of ids"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}] * 5)],
+                        }])
+            products = template.products
+            supplier, = Location.search([('code', '=', 'SUP')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            Move.create([{
+                        'product': product.id,
+                        'unit': unit.id,
+                        'quantity': quantity,
+                        'from_location': from_.id,
+                        'to_location': to.id,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        }
+                    for i, product in enumerate(products)
+                    for quantity, from_, to in [
+                        (10 + i, supplier, storage),
+                        (i, storage, customer),
+                        ]])
+
+            names = ['incoming_quantity', 'outgoing_quantity']
+            with patch.object(Transaction().database, 'IN_MAX', 2):
+                quantities = Product.get_in_out_quantities(products, names)
+            self.assertEqual(
+                quantities, Product.get_in_out_quantities(products, names))
+
+            with Transaction().set_context(
+                    Product._quantity_context('forecast_quantity')):
+                pbl = Product.products_by_location(
+                    [storage.id], with_childs=True,
+                    grouping_filter=([p.id for p in products],))
+            for product in products:
+                self.assertEqual(
+                    quantities['incoming_quantity'][product.id]
+                    - quantities['outgoing_quantity'][product.id],
+                    pbl[(storage.id, product.id)])
+
+    @with_transaction()
+    def test_lot_in_out_quantity(self):
+        "Test incoming and outgoing quantities of lots"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        LotsByLocations = pool.get('stock.lots_by_locations')
+        Move = pool.get('stock.move')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}])],
+                        }])
+            product, = template.products
+            lot1, lot2 = Lot.create([{
+                        'number': '1',
+                        'product': product.id,
+                        }, {
+                        'number': '2',
+                        'product': product.id,
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            Move.create([{
+                        'product': product.id,
+                        'lot': lot.id,
+                        'unit': unit.id,
+                        'quantity': quantity,
+                        'from_location': from_.id,
+                        'to_location': to.id,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        } for lot, quantity, from_, to in [
+                        (lot1, 4, supplier, storage),
+                        (lot2, 6, supplier, storage),
+                        (lot2, 1, storage, customer),
+                        ]])
+
+            self.assertEqual(
+                Lot.get_in_out_quantities(
+                    [lot1, lot2], ['incoming_quantity', 'outgoing_quantity']),
+                {
+                    'incoming_quantity': {lot1.id: 4, lot2.id: 6},
+                    'outgoing_quantity': {lot1.id: 0, lot2.id: 1},
+                    })
+            self.assertEqual(
+                Lot.search([('incoming_quantity', '>', 5)]), [lot2])
+            self.assertEqual(
+                Lot.search([('outgoing_quantity', '=', 0)]), [lot1])
+
+            with Transaction().set_context(locations=[storage.id]):
+                self.assertEqual(
+                    LotsByLocations.read([lot1.id, lot2.id], [
+                            'quantity', 'incoming_quantity',
+                            'outgoing_quantity']),
+                    [{
+                            'id': lot1.id,
+                            'quantity': 0,
+                            'incoming_quantity': 4,
+                            'outgoing_quantity': 0,
+                            }, {
+                            'id': lot2.id,
+                            'quantity': 0,
+                            'incoming_quantity': 6,
+                            'outgoing_quantity': 1,
+                            }])
+
+    @with_transaction()
+    @patch.object(QuantityPending, 'enabled', staticmethod(lambda: True))
+    def test_pending_quantity(self):
+        "Test incoming and outgoing quantities from the pending summary"
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Lot = pool.get('stock.lot')
+        Move = pool.get('stock.move')
+        Pending = pool.get('product.quantity.pending')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Product',
+                        'type': 'goods',
+                        'default_uom': unit.id,
+                        'products': [('create', [{}])],
+                        }])
+            product, = template.products
+            lot1, lot2 = Lot.create([{
+                        'number': '1',
+                        'product': product.id,
+                        }, {
+                        'number': '2',
+                        'product': product.id,
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            storage, = Location.search([('code', '=', 'STO')])
+            inactive, = Location.copy([supplier])
+
+            moves = Move.create([{
+                        'product': product.id,
+                        'lot': lot.id,
+                        'unit': unit.id,
+                        'quantity': quantity,
+                        'from_location': from_.id,
+                        'to_location': to.id,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        } for lot, quantity, from_, to in [
+                        (lot1, 4, supplier, storage),
+                        (lot2, 6, supplier, storage),
+                        (lot2, 1, storage, customer),
+                        (lot1, 8, inactive, storage),
+                        ]])
+            # The location can not be emptied to be inactivated
+            location = Location.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*location.update(
+                    [location.active], [False],
+                    where=location.id == inactive.id))
+            Pending.rebuild()
+
+            names = ['incoming_quantity', 'outgoing_quantity']
+
+            def quantities():
+                return (
+                    Product.get_in_out_quantities([product], names),
+                    Lot.get_in_out_quantities([lot1, lot2], names))
+
+            def check():
+                with patch.object(
+                        QuantityPending, 'enabled',
+                        staticmethod(lambda: False)):
+                    direct = quantities()
+                self.assertEqual(quantities(), direct)
+                return direct
+
+            self.assertEqual(check(), (
+                    {
+                        'incoming_quantity': {product.id: 10},
+                        'outgoing_quantity': {product.id: 1},
+                        },
+                    {
+                        'incoming_quantity': {lot1.id: 4, lot2.id: 6},
+                        'outgoing_quantity': {lot1.id: 0, lot2.id: 1},
+                        }))
+
+            Move.write([moves[0]], {'quantity': 5})
+            check()
+            Move.write([moves[1]], {'lot': lot1.id})
+            check()
+            Move.do([moves[2]])
+            check()
+            Move.delete([moves[0]])
+            check()
+            Pending.rebuild()
+            self.assertEqual(check(), (
+                    {
+                        'incoming_quantity': {product.id: 6},
+                        'outgoing_quantity': {product.id: 0},
+                        },
+                    {
+                        'incoming_quantity': {lot1.id: 6, lot2.id: 0},
+                        'outgoing_quantity': {lot1.id: 0, lot2.id: 0},
+                        }))
+
+
 del ModuleTestCase
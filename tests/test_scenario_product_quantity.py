@@ -257,6 +257,11 @@ class Test(unittest.TestCase):
         self.assertEqual(product2.incoming_quantity, 50.0)
         self.assertEqual(product2.outgoing_quantity, 40.0)
 
+        template2 = ProductTemplate(product2.template.id)
+        self.assertEqual(template2.available_quantity, 0.0)
+        self.assertEqual(template2.incoming_quantity, 50.0)
+        self.assertEqual(template2.outgoing_quantity, 40.0)
+
         product_by_loc2.reload()
         self.assertEqual(product_by_loc2.incoming_quantity, 50.0)
         self.assertEqual(product_by_loc2.outgoing_quantity, 40.0)
@@ -272,3 +277,70 @@ class Test(unittest.TestCase):
             ('product', '=', product2),('outgoing_quantity', '=', 40)])), 1)
         self.assertEqual(len(ProductByLocations.find([
             ('product', '=', product2),('outgoing_quantity', '<', 40)])), 0)
+
+        # Products without moves have no incoming nor outgoing quantity
+        self.assertEqual(
+            Product.find([('incoming_quantity', '=', 0)]), [product])
+        self.assertEqual(
+            Product.find([('incoming_quantity', '>', 0)]), [product2])
+        self.assertEqual(
+            Product.find([('outgoing_quantity', '!=', 40)]), [product])
+
+        # Lag days limit the moves taken into account
+        move = Move(
+            from_location=supplier_loc,
+            to_location=storage,
+            product=product2,
+            unit=product2.default_uom,
+            unit_price=Decimal(10),
+            currency=company.currency,
+            quantity=25.0,
+            planned_date=today + datetime.timedelta(days=10),
+            )
+        move.save()
+
+        product2.reload()
+        self.assertEqual(product2.incoming_quantity, 75.0)
+
+        configuration.lag_days = Decimal(5)
+        configuration.save()
+        product2.reload()
+        self.assertEqual(product2.incoming_quantity, 0.0)
+        self.assertEqual(product2.outgoing_quantity, 0.0)
+
+        configuration.lag_days = Decimal(20)
+        configuration.save()
+        product2.reload()
+        self.assertEqual(product2.incoming_quantity, 25.0)
+
+        configuration.lag_days = None
+        configuration.save()
+
+        # Available quantity cache is cleared when moves change of state
+        configuration.available_quantity_cache = 3600
+        configuration.save()
+        product.reload()
+        self.assertEqual(product.available_quantity, 100.0)
+
+        move = Move(
+            from_location=storage,
+            to_location=customer_loc,
+            product=product,
+            unit=product.default_uom,
+            unit_price=Decimal(10),
+            currency=company.currency,
+            quantity=10.0,
+            )
+        move.save()
+        move.click('do')
+
+        product.reload()
+        self.assertEqual(product.available_quantity, 90.0)
+
+        # The cached quantity depends on the children of the locations
+        with config.set_context(locations=[warehouse.id]):
+            self.assertEqual(
+                Product(product.id).available_quantity, 90.0)
+        with config.set_context(locations=[warehouse.id], with_childs=False):
+            self.assertEqual(
+                Product(product.id).available_quantity, 0.0)